@@ -0,0 +1,126 @@
+"""
+Latency of the per-user history query (newest 10 generations) on a large generations
+table, with and without the (user_id, created_at) index, and of scrolling deep into a
+user's history with keyset pagination versus OFFSET.
+
+Run from the repository root:
+    python -m music_gen.benchmarks.history_benchmark [--rows 1000000 --users 1000]
+"""
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+from sqlalchemy.orm import sessionmaker
+
+from music_gen.modules.db import Base, Generation, make_engine
+from music_gen.modules.history import query_page
+
+HEAVY_USER = 0
+
+def populate(engine, n_rows, n_users, heavy_rows, seed=0, chunk=50000):
+    """
+    Inserts n_rows generations in creation order like the app: about heavy_rows of them
+    belong to HEAVY_USER, the rest are spread over the other users.
+    """
+    rng = random.Random(seed)
+    start = datetime(2024, 1, 1)
+    heavy_share = heavy_rows / n_rows
+    with engine.begin() as conn:
+        for offset in range(0, n_rows, chunk):
+            rows = [{"user_id": HEAVY_USER if rng.random() < heavy_share else rng.randrange(1, n_users),
+                     "filename": f"melody_{i}.wav",
+                     "image_filename": f"viz_{i}.png", "peaks_filename": f"peaks_{i}.peaks",
+                     "prompt": "Manual: C4:1 E4:1 G4:2", "created_at": start + timedelta(seconds=i)}
+                    for i in range(offset, min(offset + chunk, n_rows))]
+            conn.execute(Generation.__table__.insert(), rows)
+
+def time_history(Session, n_users, queries, limit=10, seed=1):
+    """
+    Milliseconds per history query for random users, exactly as the history panel runs it.
+    """
+    rng = random.Random(seed)
+    timings = []
+    for _ in range(queries):
+        user_id = rng.randrange(1, n_users)
+        started = time.perf_counter()
+        with Session() as db:
+            db.query(Generation).filter(Generation.user_id == user_id).order_by(Generation.created_at.desc()).limit(limit).all()
+        timings.append((time.perf_counter() - started) * 1000)
+    return timings
+
+def time_page(Session, depth, queries, limit=10):
+    """
+    Milliseconds to fetch page `depth` of HEAVY_USER's history, as (keyset, offset) timings.
+    The keyset cursor is what the previous page would have handed back.
+    """
+    def ordered(db):
+        return db.query(Generation).filter(Generation.user_id == HEAVY_USER).order_by(Generation.created_at.desc(), Generation.id.desc())
+
+    with Session() as db:
+        last = ordered(db).offset(depth * limit - 1).first() if depth else None
+        if depth and last is None:
+            return None
+        cursor = (last.created_at, last.id) if last else None
+
+        keyset, offset = [], []
+        for _ in range(queries):
+            started = time.perf_counter()
+            keyset_rows, _ = query_page(db, HEAVY_USER, before=cursor, limit=limit)
+            keyset.append((time.perf_counter() - started) * 1000)
+
+            started = time.perf_counter()
+            offset_rows = ordered(db).offset(depth * limit).limit(limit).all()
+            offset.append((time.perf_counter() - started) * 1000)
+        assert [row.id for row in keyset_rows] == [row.id for row in offset_rows]
+    return keyset, offset
+
+def report(label, timings):
+    timings = sorted(timings)
+    p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+    print(f"{label:<12} {statistics.median(timings):>10.3f} {p95:>10.3f} {len(timings):>8}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Generation history query benchmark")
+    parser.add_argument("--rows", type=int, default=1000000, help="Generations in the table")
+    parser.add_argument("--users", type=int, default=1000, help="Distinct users")
+    parser.add_argument("--queries", type=int, default=500, help="History queries with the index")
+    parser.add_argument("--scan-queries", type=int, default=20, help="History queries without the index")
+    parser.add_argument("--heavy", type=int, default=100000, help="Generations owned by the one heavy user")
+    parser.add_argument("--depths", type=int, nargs="+", default=[0, 100, 1000, 9000], help="Pages to fetch for the heavy user")
+    parser.add_argument("--page-queries", type=int, default=50, help="Fetches per page depth")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = make_engine(f"sqlite:///{os.path.join(tmp, 'history.db')}")
+        Session = sessionmaker(bind=engine)
+        Base.metadata.create_all(bind=engine)
+
+        started = time.perf_counter()
+        populate(engine, args.rows, args.users, args.heavy)
+        print(f"Inserted {args.rows} generations for {args.users} users in {time.perf_counter() - started:.1f}s")
+
+        print(f"{'index':<12} {'p50 ms':>10} {'p95 ms':>10} {'queries':>8}")
+        report("user+time", time_history(Session, args.users, args.queries))
+
+        for depth in args.depths:
+            timings = time_page(Session, depth, args.page_queries)
+            if timings is None:
+                print(f"page {depth}: heavy user has fewer pages")
+                continue
+            print(f"\n{'page ' + str(depth):<12} {'p50 ms':>10} {'p95 ms':>10} {'queries':>8}")
+            report("keyset", timings[0])
+            report("offset", timings[1])
+        print()
+
+        with engine.begin() as conn:
+            conn.execute(text("DROP INDEX ix_generations_user_created"))
+        report("none", time_history(Session, args.users, args.scan_queries))
+        engine.dispose()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Train, compose and compose_batch cost of MarkovComposer as model order and corpus size grow.
+
+Run from the repository root:
+    python -m music_gen.benchmarks.markov_benchmark [--sizes 1000 10000 100000]
+"""
+import argparse
+import random
+import time
+
+from music_gen.modules.composer import MarkovComposer
+
+PITCHES = [f"{name}{octave}" for octave in (3, 4, 5) for name in
+           ("C", "C#", "D", "D#", "E", "F", "F#", "G", "G#", "A", "A#", "B")]
+DURATIONS = ["0.25", "0.5", "1", "1.5", "2"]
+
+def synthetic_corpus(n_melodies, notes_per_melody=32, seed=0):
+    """
+    Random-walk melodies of Note:Duration tokens, roughly like songs.txt.
+    """
+    rng = random.Random(seed)
+    melodies = []
+    for _ in range(n_melodies):
+        position = rng.randrange(len(PITCHES))
+        tokens = []
+        for _ in range(notes_per_melody):
+            position = min(max(position + rng.choice((-2, -1, -1, 0, 1, 1, 2)), 0), len(PITCHES) - 1)
+            tokens.append(f"{PITCHES[position]}:{rng.choice(DURATIONS)}")
+        melodies.append(" ".join(tokens))
+    return melodies
+
+def main():
+    parser = argparse.ArgumentParser(description="MarkovComposer train/compose benchmark")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000], help="Corpus sizes in melodies")
+    parser.add_argument("--orders", type=int, nargs="+", default=[1, 2, 3, 4], help="Model orders")
+    parser.add_argument("--compose", type=int, default=200, help="Melodies composed per configuration")
+    parser.add_argument("--batch", type=int, default=5000, help="Melodies per compose_batch call")
+    parser.add_argument("--length", type=int, default=64, help="Notes per composed melody")
+    args = parser.parse_args()
+
+    print(f"{'melodies':>9} {'order':>5} {'durations':>9} {'transitions':>11} {'train s':>8} "
+          f"{'us/note':>8} {'batch us/note':>13}")
+    for size in args.sizes:
+        corpus = synthetic_corpus(size)
+        for order in args.orders:
+            for durations in ("joint", "separate"):
+                composer = MarkovComposer(order=order, durations=durations)
+
+                start = time.perf_counter()
+                composer.train(corpus)
+                train_time = time.perf_counter() - start
+
+                random.seed(0)
+                start = time.perf_counter()
+                for _ in range(args.compose):
+                    composer.compose(length=args.length)
+                per_note = (time.perf_counter() - start) / (args.compose * args.length) * 1e6
+
+                start = time.perf_counter()
+                composer.compose_batch(args.batch, length=args.length, seed=0)
+                batch_per_note = (time.perf_counter() - start) / (args.batch * args.length) * 1e6
+
+                print(f"{size:>9} {order:>5} {durations:>9} {composer.num_transitions:>11} "
+                      f"{train_time:>8.3f} {per_note:>8.2f} {batch_per_note:>13.3f}")
+
+if __name__ == "__main__":
+    main()
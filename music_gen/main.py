@@ -1,15 +1,99 @@
-
-from music_gen.modules.synthesizer import Synthesizer
+from music_gen.modules.synthesizer import Synthesizer, WAVE_TYPES
 from music_gen.modules.composer import MarkovComposer
+from concurrent.futures import ProcessPoolExecutor
+import os
 import sys
+import time
 import argparse
 
+# One synthesizer per worker process, created by the pool initializer
+_worker_synth = None
+
+def _init_worker():
+    global _worker_synth
+    _worker_synth = Synthesizer()
+
+def _render_job(job):
+    """
+    Returns (samples, sample_rate, error); error is None unless the render raised, so one
+    malformed line fails on its own instead of aborting the whole batch.
+    """
+    path, notes, bpm, wave_type = job
+    try:
+        samples = _worker_synth.render_to_wav(path, notes, bpm=bpm, wave_type=wave_type, verbose=False)
+    except Exception as e:
+        if os.path.exists(path):
+            os.remove(path) # don't leave a truncated WAV behind
+        return 0, _worker_synth.sample_rate, f"{type(e).__name__}: {e}"
+    return samples, _worker_synth.sample_rate, None
+
+def read_sequences(source):
+    """
+    Yields one note sequence per non-empty line of a file, or of stdin for '-'.
+    """
+    f = sys.stdin if source == "-" else open(source, "r")
+    try:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield line
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+def run_batch(sequences, out_dir, workers=None, bpm=120, wave_type='sine'):
+    """
+    Renders every sequence to out_dir/melody_00001.wav, ... across a process pool
+    and reports throughput.
+    """
+    sequences = list(sequences)
+    if not sequences:
+        print("No note sequences to render.")
+        return
+        
+    os.makedirs(out_dir, exist_ok=True)
+    width = max(5, len(str(len(sequences))))
+    jobs = [
+        (os.path.join(out_dir, f"melody_{i:0{width}d}.wav"), notes, bpm, wave_type)
+        for i, notes in enumerate(sequences, start=1)
+    ]
+    workers = workers or os.cpu_count() or 1
+    
+    print(f"Rendering {len(jobs)} melodies with {workers} workers...")
+    start = time.perf_counter()
+    rendered = failed = 0
+    audio_seconds = 0.0
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as pool:
+        chunksize = max(1, len(jobs) // (workers * 8))
+        results = pool.map(_render_job, jobs, chunksize=chunksize)
+        for (path, notes, _, _), (samples, sample_rate, error) in zip(jobs, results):
+            if error:
+                failed += 1
+                print(f"Failed {os.path.basename(path)} ({notes[:40]}): {error}")
+            elif samples:
+                rendered += 1
+                audio_seconds += samples / sample_rate
+    elapsed = time.perf_counter() - start
+    
+    skipped = len(jobs) - rendered - failed
+    print(f"Rendered {rendered} melodies ({audio_seconds:.1f}s of audio) to {out_dir} in {elapsed:.2f}s"
+          + (f", skipped {skipped} without notes" if skipped else "")
+          + (f", {failed} failed" if failed else ""))
+    print(f"Throughput: {rendered / elapsed:.1f} renders/s, "
+          f"{audio_seconds / elapsed:.1f} audio seconds per wall second")
+
 def main():
     parser = argparse.ArgumentParser(description="Music Generation System")
     parser.add_argument("notes", nargs="*", help="String of notes (e.g. 'C4 E4 G4')")
-    parser.add_argument("--wave", choices=['sine', 'square', 'sawtooth'], default='sine', help="Waveform type")
+    parser.add_argument("--wave", choices=WAVE_TYPES, default='sine', help="Waveform type")
     parser.add_argument("--bpm", type=int, default=120, help="Tempo in Beats Per Minute (default: 120)")
     parser.add_argument("--compose", action="store_true", help="Generate a melody using AI")
+    parser.add_argument("--length", type=int, default=20, help="Notes per Markov composition (default: 20)")
+    parser.add_argument("--batch", metavar="FILE", help="Batch mode: render one note sequence per line of FILE ('-' for stdin)")
+    parser.add_argument("--markov", type=int, metavar="N", help="Batch mode: render N Markov compositions")
+    parser.add_argument("--seed", type=int, default=None, help="Batch mode: random seed for --markov compositions")
+    parser.add_argument("--workers", type=int, default=None, help="Batch worker processes (default: CPU count)")
+    parser.add_argument("--out-dir", default="batch_output", help="Batch output directory (default: batch_output)")
     
     args = parser.parse_args()
     
@@ -18,11 +102,20 @@ def main():
     
     print("Music Generation System Initialized")
     
+    if args.batch or args.markov:
+        sequences = list(read_sequences(args.batch)) if args.batch else []
+        if args.markov:
+            print("Training AI Composer...")
+            composer.train(composer.load_data())
+            sequences.extend(composer.compose_batch(args.markov, length=args.length, seed=args.seed))
+        run_batch(sequences, args.out_dir, workers=args.workers, bpm=args.bpm, wave_type=args.wave)
+        return
+    
     if args.compose:
         print("Training AI Composer...")
         data = composer.load_data()
         composer.train(data)
-        input_string = composer.compose(length=20)
+        input_string = composer.compose(length=args.length)
         print(f"AI Composed: {input_string}")
         # Default BPM for AI is 120, can be overridden
     elif args.notes:
@@ -33,11 +126,9 @@ def main():
         
     print(f"Generating audio for: {input_string} using {args.wave} wave at {args.bpm} BPM")
     
-    audio_data = synth.generate_audio(input_string, bpm=args.bpm, wave_type=args.wave)
-    
-    if audio_data is not None:
-        output_file = "output.wav"
-        synth.save_wav(output_file, audio_data)
+    # Stream straight to disk so long melodies never sit in memory
+    output_file = "output.wav"
+    if synth.render_to_wav(output_file, input_string, bpm=args.bpm, wave_type=args.wave):
         print("Done!")
     else:
         print("No valid notes found to generate audio.")
@@ -1,11 +1,110 @@
 
 import os
+import asyncio
+import hashlib
+import threading
+import re
+import math
+import httpx
+from collections import OrderedDict
+from fractions import Fraction
 from .composer import MarkovComposer # Relative import inside modules package
 from typing import TypedDict, Annotated, List
-from .synthesizer import Synthesizer
+from .synthesizer import Synthesizer, split_tracks, CHORD_SEPARATOR, TRACK_SEPARATOR, NOTE_NUMBERS, SHARP_NAMES
 from langgraph.graph import StateGraph, END
 from langchain_openai import ChatOpenAI
 from langchain_core.messages import SystemMessage, HumanMessage
+from langchain_core.runnables import RunnableLambda
+from .llm_cache import llm_cache
+
+SYSTEM_PROMPT = """You are a music composer AI. 
+        Your goal is to generate a melody based on the user's description.
+        
+        OUTPUT FORMAT RULES:
+        1. Return ONLY a string of notes separated by spaces.
+        2. Format: Note:Duration (e.g. C4:1, D#4:0.5, R:1 for rest).
+        3. Do not include any explanations, markdown, or code blocks. Just the raw string.
+        4. Use standard scientific pitch notation (C4, F#5, Bb3).
+        5. Duration is in beats (0.5 = eighth note, 1 = quarter note, 2 = half note).
+        6. Chords join notes with + (e.g. C4+E4+G4:2). Optionally add an accompaniment track after a | separator.
+        
+        Example Output:
+        C4:1 E4:1 G4:1 C5:2 G4:1 E4:1 C4:2
+        """
+
+# Durations outside this range (in beats) are clamped by repair_notes
+DURATION_RANGE = (0.0625, 8.0)
+
+def _repair_duration(duration):
+    try:
+        value = float(Fraction(duration)) # accepts "0.5" and "1/2"
+    except (ValueError, ZeroDivisionError):
+        return 1.0
+    if not math.isfinite(value):
+        return 1.0
+    low, high = DURATION_RANGE
+    return min(max(value, low), high)
+
+def _repair_token(token):
+    """
+    Canonical "Note:Duration" form of one token, or None if it is not recoverable.
+    Flats and enharmonics become sharp names (Bb3 -> A#3, B#3 -> C4); a missing or
+    unreadable duration defaults to one beat.
+    """
+    token = token.strip(".,;()[]{}*\"'")
+    pitch, separator, duration = token.partition(":")
+    notes = []
+    for note in pitch.split(CHORD_SEPARATOR):
+        name = note.replace("\u266f", "#").replace("\u266d", "b").upper()
+        if name in ("R", "REST"):
+            continue
+        # Without a duration, only names with an octave count ("C4"); a lone "A" or "60"
+        # is far more likely to be prose
+        has_octave = any(ch.isdigit() for ch in name) and not name.isdigit()
+        number = NOTE_NUMBERS.get(name) if separator or has_octave else None
+        if number is None:
+            return None
+        canonical = f"{SHARP_NAMES[number % 12]}{number // 12 - 1}"
+        notes.append(canonical if canonical in NOTE_NUMBERS else str(number))
+    if not notes and pitch.upper() not in ("R", "REST"):
+        return None
+    duration = _repair_duration(duration.split(":")[0]) if duration else 1.0
+    return f"{CHORD_SEPARATOR.join(notes) or 'R'}:{duration:g}"
+
+def repair_notes(text):
+    """
+    Deterministically fixes common LLM format slips: strips markdown and prose lines,
+    defaults missing durations, normalizes flats and enharmonics, drops garbage tokens and
+    clamps absurd durations. Returns (notes, quality), quality being the share of tokens
+    on the melody lines that survived.
+    """
+    text = re.sub(r"```[a-zA-Z]*", "\n", text).replace("`", " ").replace("**", " ")
+    kept_tracks = []
+    kept = total = 0
+    for line in text.splitlines():
+        line_tracks = []
+        line_kept = line_total = 0
+        for track in line.split(TRACK_SEPARATOR):
+            tokens = [token for token in re.split(r"[\s,]+", track) if token]
+            repaired = [r for r in map(_repair_token, tokens) if r is not None]
+            line_kept += len(repaired)
+            line_total += len(tokens)
+            line_tracks.append(repaired)
+        # Lines that are mostly words ("Here is your melody:") are prose, not music
+        if line_total == 0 or line_kept < line_total / 2:
+            continue
+        # Lines follow one another in time: a melody wrapped over several lines stays one
+        # track, and only an explicit separator puts notes in another (the i-th part of
+        # every line continues track i)
+        for i, repaired in enumerate(line_tracks):
+            if i == len(kept_tracks):
+                kept_tracks.append([])
+            kept_tracks[i].extend(repaired)
+        kept += line_kept
+        total += line_total
+    if total == 0:
+        return "", 0.0
+    return f" {TRACK_SEPARATOR} ".join(" ".join(track) for track in kept_tracks if track), kept / total
 
 # Define the State
 class AgentState(TypedDict):
@@ -14,28 +113,69 @@ class AgentState(TypedDict):
     is_valid: bool
     error: str
     retries: int
+    repaired: bool
+    cache_key: str # set while a freshly generated reply awaits validation
+
+_http_client = None
+_http_client_lock = threading.Lock()
+
+def shared_http_client():
+    """
+    One keep-alive connection pool to OpenRouter for every agent in the process, so only
+    the first request pays for TCP/TLS setup. httpx.Client is thread-safe.
+    """
+    global _http_client
+    with _http_client_lock:
+        if _http_client is None:
+            _http_client = httpx.Client(
+                limits=httpx.Limits(max_connections=64, max_keepalive_connections=16, keepalive_expiry=120),
+                timeout=httpx.Timeout(120, connect=10),
+            )
+        return _http_client
 
 class MusicAgent:
-    def __init__(self, api_key, model_name="google/gemini-2.0-flash-001"):
-        self.llm = ChatOpenAI(
+    def __init__(self, api_key, model_name="google/gemini-2.0-flash-001", llm=None, cache=llm_cache,
+                 repair_threshold=0.8):
+        """
+        llm: any LangChain chat model to use instead of the OpenRouter client (e.g. a local stub).
+        cache: LLMCache for responses, or None to always call the model.
+        repair_threshold: share of tokens that must survive local repair for an invalid
+        reply to be accepted without asking the LLM again.
+        Prefer get_agent(), which reuses agents (and their compiled graphs) across requests.
+        """
+        self.model_name = model_name
+        self.llm = llm or ChatOpenAI(
             api_key=api_key,
             base_url="https://openrouter.ai/api/v1",
             model=model_name,
-            temperature=0.7
+            temperature=0.7,
+            http_client=shared_http_client()
         )
+        self.cache = cache
+        self.repair_threshold = repair_threshold
         self.workflow = self._build_graph()
 
     def _build_graph(self):
         workflow = StateGraph(AgentState)
         
-        workflow.add_node("generate", self.generate_step)
+        # Sync invoke() and async ainvoke() each get a native generate step
+        workflow.add_node("generate", RunnableLambda(self.generate_step, afunc=self.agenerate_step))
         workflow.add_node("validate", self.validate_step)
+        workflow.add_node("repair", self.repair_step)
         
         workflow.set_entry_point("generate")
         
         workflow.add_edge("generate", "validate")
         workflow.add_conditional_edges(
             "validate",
+            lambda state: "end" if state["is_valid"] else "repair",
+            {
+                "end": END,
+                "repair": "repair"
+            }
+        )
+        workflow.add_conditional_edges(
+            "repair",
             self.should_continue,
             {
                 "end": END,
@@ -45,40 +185,61 @@ class MusicAgent:
         
         return workflow.compile()
 
-    def generate_step(self, state: AgentState):
+    def _prompt(self, state: AgentState):
+        # Returns (messages, cache key or None) for the next generation attempt
         topic = state["topic"]
         error = state.get("error", "")
-        retries = state.get("retries", 0)
-        
-        print(f"--- Generating (Attempt {retries + 1}) ---")
         
-        system_prompt = """You are a music composer AI. 
-        Your goal is to generate a melody based on the user's description.
-        
-        OUTPUT FORMAT RULES:
-        1. Return ONLY a string of notes separated by spaces.
-        2. Format: Note:Duration (e.g. C4:1, D#4:0.5, R:1 for rest).
-        3. Do not include any explanations, markdown, or code blocks. Just the raw string.
-        4. Use standard scientific pitch notation (C4, F#5, Bb3).
-        5. Duration is in beats (0.5 = eighth note, 1 = quarter note, 2 = half note).
-        
-        Example Output:
-        C4:1 E4:1 G4:1 C5:2 G4:1 E4:1 C4:2
-        """
+        print(f"--- Generating (Attempt {state.get('retries', 0) + 1}) ---")
         
         user_msg = f"Compose a melody for: {topic}"
         if error:
             user_msg += f"\n\nPREVIOUS ERROR: {error}\nPlease fix the format."
 
         messages = [
-            SystemMessage(content=system_prompt),
+            SystemMessage(content=SYSTEM_PROMPT),
             HumanMessage(content=user_msg)
         ]
-        
-        response = self.llm.invoke(messages)
-        content = response.content.strip().replace("`", "").replace("python", "")
-        
-        return {"notes": content, "retries": retries + 1}
+        key = None
+        if self.cache is not None:
+            key = self.cache.key(self.model_name, SYSTEM_PROMPT, user_msg, getattr(self.llm, "temperature", None))
+        return messages, key
+
+    def _result(self, state: AgentState, content, cache_key=None):
+        content = content.strip().replace("`", "").replace("python", "")
+        return {"notes": content, "retries": state.get("retries", 0) + 1, "cache_key": cache_key}
+
+    def _accept(self, state: AgentState, notes):
+        # Replies are cached only once they are known to be usable; a bad reply cached under
+        # a retry prompt would come back on every later retry with the same error
+        if state.get("cache_key") and self.cache is not None:
+            self.cache.put(state["cache_key"], notes)
+
+    def generate_step(self, state: AgentState):
+        messages, key = self._prompt(state)
+        if key is None:
+            return self._result(state, self.llm.invoke(messages).content)
+
+        computed = []
+        def call():
+            computed.append(True)
+            return self.llm.invoke(messages).content
+
+        content = self.cache.get_or_compute(key, call, store=False)
+        return self._result(state, content, key if computed else None)
+
+    async def agenerate_step(self, state: AgentState):
+        messages, key = self._prompt(state)
+        computed = []
+
+        async def call():
+            computed.append(True)
+            return (await self.llm.ainvoke(messages)).content
+
+        if key is None:
+            return self._result(state, await call())
+        content = await self.cache.aget_or_compute(key, call, store=False)
+        return self._result(state, content, key if computed else None)
 
     def validate_step(self, state: AgentState):
         notes = state["notes"]
@@ -91,7 +252,7 @@ class MusicAgent:
         valid_notes = True
         invalid_tokens = []
         
-        tokens = notes.split()
+        tokens = [token for track in split_tracks(notes) for token in track]
         if len(tokens) < 2:
              return {"is_valid": False, "error": "Melody too short"}
 
@@ -107,11 +268,13 @@ class MusicAgent:
                 invalid_tokens.append(f"{token} (bad format)")
                 continue
                 
-            note, duration = parts
-            # Check note format (roughly)
-            if note.upper() not in ["R", "REST"] and len(note) < 2:
-                 valid_notes = False
-                 invalid_tokens.append(f"{token} (invalid note)")
+            chord, duration = parts
+            # Every note must be one the synthesizer knows; chords are notes joined with '+'
+            for note in chord.split(CHORD_SEPARATOR):
+                if note.upper() not in ["R", "REST"] and note.upper() not in NOTE_NUMBERS:
+                     valid_notes = False
+                     invalid_tokens.append(f"{token} (invalid note)")
+                     break
             
             try:
                 float(duration)
@@ -120,10 +283,24 @@ class MusicAgent:
                 invalid_tokens.append(f"{token} (invalid duration)")
 
         if valid_notes:
+            self._accept(state, notes)
             return {"is_valid": True, "error": ""}
         else:
             return {"is_valid": False, "error": f"Invalid tokens: {', '.join(invalid_tokens[:3])}"}
 
+    def repair_step(self, state: AgentState):
+        """
+        Tries to fix an invalid reply locally so a format slip doesn't cost another LLM call.
+        """
+        notes, quality = repair_notes(state["notes"])
+        tokens = [token for track in split_tracks(notes) for token in track]
+        if quality >= self.repair_threshold and len(tokens) >= 2:
+            print(f"--- Repaired locally ({quality:.0%} of tokens kept) ---")
+            self._accept(state, notes)
+            return {"notes": notes, "is_valid": True, "error": "", "repaired": True}
+        print(f"--- Repair kept only {quality:.0%} of tokens ---")
+        return {}
+
     def should_continue(self, state: AgentState):
         if state["is_valid"]:
             return "end"
@@ -131,17 +308,156 @@ class MusicAgent:
             return "end" # Give up after 3 retries
         return "retry"
 
-    def run(self, topic):
-        initial_state = {
+    def stream_notes(self, topic):
+        """
+        Streams the reply to the first attempt; see NoteStream.
+        """
+        return NoteStream(self, topic)
+
+    @staticmethod
+    def _initial_state(topic):
+        return {
             "topic": topic,
             "notes": "",
             "is_valid": False,
             "error": "",
-            "retries": 0
+            "retries": 0,
+            "repaired": False,
+            "cache_key": None
         }
-        result = self.workflow.invoke(initial_state)
+
+    def run(self, topic):
+        result = self.workflow.invoke(self._initial_state(topic))
         return result
 
+    async def arun(self, topic, timeout=None):
+        """
+        Async run(): the whole generate/validate/retry loop awaits the model instead of
+        blocking a thread. Raises asyncio.TimeoutError after timeout seconds.
+        """
+        return await asyncio.wait_for(self.workflow.ainvoke(self._initial_state(topic)), timeout)
+
+    async def arun_batch(self, topics, max_concurrency=8, timeout=120):
+        """
+        Runs every topic concurrently, at most max_concurrency at a time, each limited to
+        timeout seconds. Returns one final state per topic, in order; a topic that times out
+        or fails comes back invalid with the reason in "error".
+        """
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def one(topic):
+            async with semaphore:
+                try:
+                    return await self.arun(topic, timeout)
+                except asyncio.TimeoutError:
+                    error = f"Timed out after {timeout}s"
+                except Exception as e:
+                    error = f"{type(e).__name__}: {e}"
+            print(f"Agent failed for '{topic}': {error}")
+            return dict(self._initial_state(topic), error=error)
+
+        return await asyncio.gather(*(one(topic) for topic in topics))
+
+    def run_batch(self, topics, max_concurrency=8, timeout=120):
+        """
+        Blocking wrapper around arun_batch for scripts and other sync callers.
+        """
+        return asyncio.run(self.arun_batch(topics, max_concurrency, timeout))
+
+class NoteStream:
+    """
+    Iterates over canonical "Note:Duration" tokens parsed from a streaming LLM reply as they
+    arrive, so synthesis can start before the reply is complete. Only plain melody is
+    streamed; once a track separator or a chord shows up the remaining tokens are held
+    back, since streaming renders one voice and would clip them.
+    After iterating, result() validates (and if needed repairs or regenerates) the full reply
+    exactly like MusicAgent.run() and returns the final state.
+    """
+    def __init__(self, agent, topic):
+        self.agent = agent
+        self.topic = topic
+        self.text = ""
+        self.tokens = []
+        self.multitrack = False
+        self.chords = False
+        self.cache_key = None
+
+    def __iter__(self):
+        agent = self.agent
+        messages, key = agent._prompt(agent._initial_state(self.topic))
+        cached = agent.cache.get(key) if key is not None else None
+        chunks = [cached] if cached is not None else (chunk.content for chunk in agent.llm.stream(messages))
+
+        pending = ""
+        for piece in chunks:
+            self.text += piece
+            # Everything before the last separator is complete; the tail may still grow
+            *complete, pending = re.split(r"[\s,]+", pending + piece)
+            for raw in complete:
+                yield from self._emit(raw)
+        for raw in pending.split():
+            yield from self._emit(raw)
+        # result() caches the reply once it has been validated
+        self.cache_key = key if cached is None else None
+
+    def _emit(self, raw):
+        if TRACK_SEPARATOR in raw:
+            self.multitrack = True
+        if self.multitrack or self.chords:
+            return
+        token = _repair_token(raw)
+        if token is not None and CHORD_SEPARATOR in token:
+            self.chords = True
+            return
+        if token is not None:
+            self.tokens.append(token)
+            yield token
+
+    def result(self):
+        """
+        Final state for the streamed reply; falls back to the usual repair/retry loop.
+        """
+        agent = self.agent
+        state = dict(agent._initial_state(self.topic),
+                     **agent._result(agent._initial_state(self.topic), self.text, self.cache_key))
+        state.update(agent.validate_step(state))
+        if not state["is_valid"]:
+            state.update(agent.repair_step(state))
+        if agent.should_continue(state) == "retry":
+            state = agent.workflow.invoke(state)
+        return state
+
+    def matches(self, state):
+        """
+        True if the streamed tokens are exactly the final melody, so audio rendered from
+        them can be used as-is.
+        """
+        return (state["is_valid"] and not self.multitrack and not self.chords
+                and repair_notes(state["notes"])[0] == " ".join(self.tokens))
+
+# Process-wide agents keyed by (api key hash, model); least recently used dropped first
+AGENT_POOL_SIZE = 32
+_agent_pool = OrderedDict()
+_agent_pool_lock = threading.Lock()
+
+def get_agent(api_key, model_name="google/gemini-2.0-flash-001"):
+    """
+    Returns the shared MusicAgent for this API key and model, creating it on first use.
+    Agents hold no per-run state, so sessions and threads can share them; later requests
+    skip client construction and graph compilation. Keys are only kept hashed.
+    """
+    pool_key = (hashlib.sha256((api_key or "").encode("utf-8")).hexdigest(), model_name)
+    with _agent_pool_lock:
+        agent = _agent_pool.get(pool_key)
+        if agent is not None:
+            _agent_pool.move_to_end(pool_key)
+            return agent
+        agent = MusicAgent(api_key, model_name)
+        _agent_pool[pool_key] = agent
+        while len(_agent_pool) > AGENT_POOL_SIZE:
+            _agent_pool.popitem(last=False)
+        return agent
+
 def get_available_models(api_key: str = None, only_free: bool = True) -> List[str]:
     """
     Fetches the list of available models from OpenRouter.
@@ -1,10 +1,561 @@
-
+import hashlib
+import json
+import os
 import random
+import threading
+from fractions import Fraction
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+try:
+    import fcntl
+except ImportError: # Windows: saves are not serialized across processes
+    fcntl = None
+
+from .synthesizer import NOTE_NUMBERS, PITCH_CLASSES, CHORD_SEPARATOR
+
+class TransitionTable:
+    """
+    Counts of next-token ids following every observed context of `order` token ids.
+    Stored in CSR form: row i holds the distinct successors of contexts[i], their counts
+    and the running cumulative probability within the row. Rows are sorted by their
+    contexts' integer codes, which are kept (and saved) for binary-search lookups.
+    """
+    ARRAYS = ("contexts", "codes", "indptr", "successors", "counts", "cumprobs", "keys")
+
+    def __init__(self, order):
+        self.order = order
+        self.radix = 1
+        self.contexts = np.empty((0, order), dtype=np.int32)
+        self.codes = np.empty(0, dtype=np.int64)
+        self.indptr = np.zeros(1, dtype=np.int64)
+        self.successors = np.empty(0, dtype=np.int32)
+        self.counts = np.empty(0, dtype=np.int64)
+        self.cumprobs = np.empty(0, dtype=np.float64)
+        self.keys = np.empty(0, dtype=np.float64)
+        self._totals = None
+
+    def __len__(self):
+        return len(self.successors)
+
+    def _codes(self, contexts):
+        # Mixed-radix int64 key of each context row; sorts in lexicographic order
+        codes = np.zeros(len(contexts), dtype=np.int64)
+        for column in range(self.order):
+            codes *= self.radix
+            codes += contexts[:, column]
+        return codes
+
+    def build(self, contexts, targets, vocab_size, weights=None):
+        """
+        Aggregates (context, target) observations. contexts is an (N, order) id array;
+        weights optionally gives a count for each observation (default 1).
+        """
+        if vocab_size ** self.order >= 2 ** 63:
+            raise ValueError(f"Vocabulary of {vocab_size} tokens is too large for order-{self.order} contexts")
+        self.radix = max(vocab_size, 1)
+        self._totals = None
+
+        codes = self._codes(contexts)
+        order = np.lexsort((targets, codes))
+        codes = codes[order]
+        targets = targets[order]
+
+        new_pair = np.ones(len(codes), dtype=bool)
+        new_pair[1:] = (codes[1:] != codes[:-1]) | (targets[1:] != targets[:-1])
+        pair_starts = np.flatnonzero(new_pair)
+        pair_codes = codes[pair_starts]
+
+        new_context = np.ones(len(pair_codes), dtype=bool)
+        new_context[1:] = pair_codes[1:] != pair_codes[:-1]
+        context_starts = np.flatnonzero(new_context)
+
+        self.contexts = contexts[order[pair_starts[context_starts]]].astype(np.int32)
+        self.codes = pair_codes[context_starts]
+        self.indptr = np.append(context_starts, len(pair_codes)).astype(np.int64)
+        self.successors = targets[pair_starts].astype(np.int32)
+        if weights is None:
+            self.counts = np.diff(np.append(pair_starts, len(codes))).astype(np.int64)
+        elif len(codes):
+            self.counts = np.add.reduceat(np.asarray(weights, dtype=np.int64)[order], pair_starts)
+        else:
+            self.counts = np.empty(0, dtype=np.int64)
+        self._finish()
+
+    def transitions(self):
+        """
+        (contexts, successors, counts) with one context row per stored transition.
+        """
+        rows = np.repeat(np.arange(len(self.contexts)), np.diff(self.indptr))
+        return np.asarray(self.contexts)[rows], self.successors, self.counts
+
+    def merged(self, contexts, targets, vocab_size, weights=None):
+        """
+        Returns a new table holding these counts plus the extra (context, target)
+        observations (weighted like build()). Cost is linear in the stored transitions
+        plus the new ones; self is left untouched, so readers holding it (or its memory
+        maps) are unaffected.
+        """
+        table = TransitionTable(self.order)
+        stored_contexts, stored_targets, stored_counts = self.transitions()
+        table.build(
+            np.concatenate((stored_contexts, contexts)),
+            np.concatenate((stored_targets, targets)),
+            vocab_size,
+            np.concatenate((stored_counts, np.ones(len(targets), dtype=np.int64) if weights is None else weights)),
+        )
+        return table
+
+    @property
+    def totals(self):
+        # Observation count of every row, for mixing this table with others
+        if self._totals is None:
+            self._totals = np.add.reduceat(self.counts, self.indptr[:-1]) if len(self.counts) \
+                else np.empty(0, dtype=np.int64)
+        return self._totals
+
+    def _finish(self):
+        """
+        Precomputes per-row cumulative probabilities from the counts, and the sampling
+        keys: offsetting each row's cumulative probabilities by its row number gives one
+        monotonic array that a single searchsorted can sample every row from.
+        """
+        rows = np.repeat(np.arange(len(self.contexts)), np.diff(self.indptr))
+        running = np.concatenate(([0], np.cumsum(self.counts)))
+        row_base = running[self.indptr[:-1]]
+        row_total = running[self.indptr[1:]] - row_base
+        self.cumprobs = (running[1:] - row_base[rows]) / row_total[rows]
+        self.keys = rows + self.cumprobs
+
+    def load_arrays(self, arrays, radix):
+        """
+        Adopts previously built arrays (possibly read-only memory maps) as-is.
+        """
+        for name in self.ARRAYS:
+            setattr(self, name, arrays[name])
+        self.radix = radix
+        self._totals = None
+
+    def row(self, context):
+        """
+        Row of a context tuple of ids, or None if it was never observed. Binary search of
+        the context's integer code in the sorted codes. Ids past the radix (tokens added
+        since the table was built) are never in it.
+        """
+        if any(token_id >= self.radix for token_id in context):
+            return None
+        code = 0
+        for token_id in context:
+            code = code * self.radix + token_id
+        row = int(np.searchsorted(self.codes, code))
+        if row < len(self.codes) and self.codes[row] == code:
+            return row
+        return None
+
+    def draw(self, row, u):
+        """
+        Successor id for a uniform draw u in [0, 1), by binary search over the row.
+        """
+        lo, hi = self.indptr[row], self.indptr[row + 1]
+        offset = np.searchsorted(self.cumprobs[lo:hi], u, side="right")
+        return int(self.successors[lo + min(offset, hi - lo - 1)])
+
+    def rows_batch(self, contexts):
+        """
+        Vectorized row(): row of each context in an (N, order) id array, -1 if unseen.
+        """
+        codes = self.codes
+        if len(codes) == 0:
+            return np.full(len(contexts), -1, dtype=np.int64)
+        query = self._codes(contexts)
+        rows = np.minimum(np.searchsorted(codes, query), len(codes) - 1)
+        known = (codes[rows] == query) & (contexts < self.radix).all(axis=1)
+        return np.where(known, rows, -1)
+
+    def draw_batch(self, rows, u):
+        """
+        Vectorized draw(): one successor id per row for uniform draws u.
+        """
+        entries = np.searchsorted(self.keys, rows + u, side="right")
+        entries = np.minimum(entries, self.indptr[rows + 1] - 1)
+        return self.successors[entries]
+
+def _draw_layers(tables, contexts, u):
+    """
+    Samples successors for an (N, k) array of contexts from the combined counts of several
+    tables over the same order. Returns (found, ids): found marks contexts seen in any
+    table, ids holds their draws. Each context picks a table in proportion to its row
+    total there, then draws within that row with the rescaled uniform.
+    """
+    if len(tables) == 1:
+        rows = tables[0].rows_batch(contexts)
+        found = rows >= 0
+        return found, tables[0].draw_batch(rows[found], u[found])
+
+    rows = [table.rows_batch(contexts) for table in tables]
+    totals = np.array([np.where(r >= 0, table.totals[np.maximum(r, 0)], 0)
+                       for table, r in zip(tables, rows)], dtype=np.float64)
+    running = np.cumsum(totals, axis=0)
+    found = running[-1] > 0
+    target = u * running[-1]
+    choice = (running <= target).sum(axis=0).clip(0, len(tables) - 1)
+
+    ids = np.empty(len(contexts), dtype=np.int64)
+    for index, table in enumerate(tables):
+        picked = np.flatnonzero(found & (choice == index))
+        if len(picked):
+            before = running[index, picked] - totals[index, picked]
+            local = (target[picked] - before) / totals[index, picked]
+            ids[picked] = table.draw_batch(rows[index][picked], np.minimum(local, np.nextafter(1.0, 0)))
+    return found, ids[found]
+
+class TokenChain:
+    """
+    Markov chain over one token stream with transition tables for every order from 1 to
+    `order`. Sampling backs off from the longest matching context to shorter ones.
+    Training is incremental: partial_train only windows the new sequences, and finalize()
+    folds them into a small delta table per order that sampling reads alongside the main
+    one. Large deltas are compacted into the main tables on a background thread.
+    """
+    # Pending observations that trigger a merge, bounding memory on long streams
+    MERGE_THRESHOLD = 1_000_000
+    # Delta transitions per order past which the delta is compacted into the main table
+    DELTA_LIMIT = 50_000
+
+    def __init__(self, order=1):
+        self.order = order
+        self._lock = threading.Lock()
+        self._compactor = None
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.vocab = []
+            self.index = {}
+            # Per order: (main, frozen, delta). frozen is a delta being compacted in the
+            # background, or None. Each triple is replaced as a whole, so samplers that read
+            # it once always see consistent counts.
+            self.layers = [(TransitionTable(k), None, TransitionTable(k)) for k in range(1, self.order + 1)]
+            self._pending = [[] for _ in self.layers]
+            self._pending_count = 0
+
+    @property
+    def tables(self):
+        # The main (compacted) table of every order
+        return [layer[0] for layer in self.layers]
+
+    @staticmethod
+    def _active(layer):
+        return [table for table in layer if table is not None and len(table)]
+
+    @property
+    def states(self):
+        # Ids with at least one successor (valid restart points)
+        tables = self._active(self.layers[0])
+        if len(tables) == 1:
+            return tables[0].contexts[:, 0]
+        return np.unique(np.concatenate([table.contexts[:, 0] for table in tables] + [np.empty(0, dtype=np.int32)]))
+
+    def _is_state(self, token_id):
+        return token_id is not None and any(table.row((token_id,)) is not None for table in self._active(self.layers[0]))
+
+    def token_id(self, token):
+        token_id = self.index.get(token)
+        if token_id is None:
+            token_id = len(self.vocab)
+            self.index[token] = token_id
+            self.vocab.append(token)
+        return token_id
+
+    def train(self, sequences):
+        """
+        sequences is an iterable of token lists. Replaces anything learned so far.
+        """
+        self.reset()
+        self.partial_train(sequences)
+        self.finalize(compact=True)
+
+    def partial_train(self, sequences):
+        """
+        Adds the transitions of more token lists to the chain. Work is proportional to
+        the new tokens; they reach the tables on the next finalize().
+        """
+        with self._lock:
+            ids = []
+            sequence_ids = []
+            for number, tokens in enumerate(sequences):
+                ids.extend(self.token_id(token) for token in tokens)
+                sequence_ids.extend([number] * len(tokens))
+            ids = np.array(ids, dtype=np.int64)
+            sequence_ids = np.array(sequence_ids, dtype=np.int64)
+
+            for k, pending in enumerate(self._pending, start=1):
+                if len(ids) <= k:
+                    continue
+                windows = sliding_window_view(ids, k + 1)
+                # Drop windows that straddle two melodies
+                windows = windows[sequence_ids[:-k] == sequence_ids[k:]]
+                if len(windows):
+                    pending.append(windows)
+                    self._pending_count += len(windows)
+
+            merge = self._pending_count >= self.MERGE_THRESHOLD
+        if merge:
+            # Bulk training; compacting right away keeps memory flat
+            self.finalize(compact=True)
+
+    def finalize(self, compact=False):
+        """
+        Folds pending observations into the delta tables, in time proportional to the new
+        observations plus the (bounded) delta. With compact=True everything is merged into
+        the main tables now; otherwise deltas past DELTA_LIMIT are compacted in the
+        background. Tables are never modified in place, only swapped.
+        """
+        with self._lock:
+            vocab_size = len(self.vocab)
+            for k, pending in enumerate(self._pending, start=1):
+                if not pending:
+                    continue
+                main, frozen, delta = self.layers[k - 1]
+                windows = np.concatenate(pending)
+                self.layers[k - 1] = (main, frozen, delta.merged(windows[:, :k], windows[:, k], vocab_size))
+                pending.clear()
+            self._pending_count = 0
+
+            if compact:
+                for k, (main, frozen, delta) in enumerate(self.layers, start=1):
+                    extra = [table.transitions() for table in (frozen, delta) if table is not None and len(table)]
+                    if extra:
+                        contexts, targets, counts = (np.concatenate(parts) for parts in zip(*extra))
+                        self.layers[k - 1] = (main.merged(contexts, targets, vocab_size, counts), None, TransitionTable(k))
+                return
+
+            if self._compactor is None and any(frozen is None and len(delta) > self.DELTA_LIMIT
+                                               for _, frozen, delta in self.layers):
+                for k, (main, frozen, delta) in enumerate(self.layers, start=1):
+                    if frozen is None and len(delta):
+                        self.layers[k - 1] = (main, delta, TransitionTable(k))
+                self._compactor = threading.Thread(target=self._compact, daemon=True, name="markov-compact")
+                self._compactor.start()
+
+    def _compact(self):
+        """
+        Background merge of every frozen delta into its main table. The result is only
+        swapped in if nobody replaced the layer meanwhile (reset, a synchronous compact).
+        """
+        try:
+            with self._lock:
+                jobs = [(k, main, frozen) for k, (main, frozen, _) in enumerate(self.layers) if frozen is not None]
+                vocab_size = len(self.vocab)
+            for k, main, frozen in jobs:
+                contexts, targets, counts = frozen.transitions()
+                merged = main.merged(contexts, targets, vocab_size, counts)
+                with self._lock:
+                    current_main, current_frozen, delta = self.layers[k]
+                    if current_main is main and current_frozen is frozen:
+                        self.layers[k] = (merged, None, delta)
+        except Exception as e:
+            print(f"Markov compaction failed: {e}")
+        finally:
+            with self._lock:
+                self._compactor = None
+
+    def next_id(self, history):
+        """
+        Draws the token following `history` (a list of ids), backing off to shorter contexts.
+        Returns None at a dead end.
+        """
+        for k in range(min(self.order, len(history)), 0, -1):
+            context = history[-k:]
+            matches = [(table, row) for table in self._active(self.layers[k - 1])
+                       for row in [table.row(context)] if row is not None]
+            if not matches:
+                continue
+            u = random.random()
+            if len(matches) > 1:
+                # Pick a table by its share of the combined row count, then rescale u
+                totals = [float(table.totals[row]) for table, row in matches]
+                target = u * sum(totals)
+                for (table, row), total in zip(matches, totals):
+                    if target < total:
+                        return table.draw(row, target / total)
+                    target -= total
+            table, row = matches[-1]
+            return table.draw(row, u)
+        return None
+
+    def generate(self, start=None, length=16):
+        """
+        Returns `length` token strings, starting from token `start` when it is a valid state.
+        """
+        if self._pending_count:
+            self.finalize()
+        states = self.states
+        if len(states) == 0:
+            return []
+
+        start_id = self.index.get(start)
+        current = start_id if self._is_state(start_id) else int(random.choice(states))
+
+        history = [current]
+        for _ in range(length - 1):
+            next_id = self.next_id(history)
+            if next_id is None:
+                # Dead end in chain, pick random restart
+                next_id = int(random.choice(states))
+            history.append(next_id)
+
+        return [self.vocab[token_id] for token_id in history]
+
+    def transition_matrix(self):
+        """
+        Dense (vocab, vocab) matrix of order-1 transition probabilities.
+        """
+        if self._pending_count:
+            self.finalize()
+        matrix = np.zeros((len(self.vocab), len(self.vocab)))
+        for table in self._active(self.layers[0]):
+            matrix[np.repeat(table.contexts[:, 0], np.diff(table.indptr)), table.successors] += table.counts
+        totals = matrix.sum(axis=1, keepdims=True)
+        return np.divide(matrix, totals, out=matrix, where=totals > 0)
+
+    def context_probs(self, history):
+        """
+        Yields dense successor distributions for `history` (a list of ids), from the longest
+        matching context down to order 1, i.e. next_id()'s backoff order.
+        """
+        for k in range(min(self.order, len(history)), 0, -1):
+            probs = np.zeros(len(self.vocab))
+            for table in self._active(self.layers[k - 1]):
+                row = table.row(history[-k:])
+                if row is not None:
+                    lo, hi = table.indptr[row], table.indptr[row + 1]
+                    probs[table.successors[lo:hi]] += table.counts[lo:hi]
+            total = probs.sum()
+            if total > 0:
+                yield probs / total
+
+    def generate_batch(self, n, length, rng, start=None):
+        """
+        Samples n sequences in lockstep with the numpy Generator rng; one vectorized
+        lookup and draw per step and order instead of a Python loop per note.
+        Returns an (n, length) id array, or None if the chain is empty.
+        """
+        if self._pending_count:
+            self.finalize()
+        layers = [self._active(layer) for layer in self.layers]
+        states = np.asarray(self.states)
+        if len(states) == 0:
+            return None
+
+        history = np.empty((n, max(length, 1)), dtype=np.int64)
+        start_id = self.index.get(start)
+        if self._is_state(start_id):
+            history[:, 0] = start_id
+        else:
+            history[:, 0] = rng.choice(states, n)
+
+        for t in range(1, length):
+            todo = np.arange(n)
+            u = rng.random(n)
+            for k in range(min(self.order, t), 0, -1):
+                if not layers[k - 1]:
+                    continue
+                found, ids = _draw_layers(layers[k - 1], history[todo, t - k:t], u[todo])
+                history[todo[found], t] = ids
+                todo = todo[~found]
+                if len(todo) == 0:
+                    break
+            if len(todo):
+                # Dead ends restart at random states
+                history[todo, t] = rng.choice(states, len(todo))
+        return history
+
+def _pitch_numbers(pitch):
+    # MIDI numbers of a note or chord; [] for a rest, None if any note is unknown
+    if pitch.upper() in ("R", "REST"):
+        return []
+    numbers = [NOTE_NUMBERS.get(note.upper()) for note in pitch.split(CHORD_SEPARATOR)]
+    return None if None in numbers else numbers
+
+def _pitch_class(name):
+    # Pitch class of "C", "C4" or "60"; None for an unknown name
+    name = name.upper()
+    if name in PITCH_CLASSES:
+        return PITCH_CLASSES[name]
+    number = NOTE_NUMBERS.get(name)
+    return None if number is None else number % 12
+
+def _duration_value(duration):
+    # Same fallback as the synthesizer: unparsable durations last one beat
+    try:
+        return float(duration)
+    except ValueError:
+        return 1.0
+
+# Finest beat subdivision and longest beat grid the constrained sampler will plan over
+BEAT_RESOLUTION = 64
+MAX_BEAT_STEPS = 4096
+
+def _beat_steps(durations, total_beats):
+    """
+    Expresses every duration and total_beats as whole multiples of their common quantum.
+    Returns (steps per duration, total steps); steps are 0 for non-positive durations.
+    """
+    fractions = [Fraction(_duration_value(d)).limit_denominator(BEAT_RESOLUTION) for d in durations]
+    total = Fraction(total_beats).limit_denominator(BEAT_RESOLUTION)
+    positive = [f for f in fractions if f > 0] + [total]
+    denominator = int(np.lcm.reduce([f.denominator for f in positive]))
+    quantum = Fraction(int(np.gcd.reduce([int(f * denominator) for f in positive])), denominator)
+
+    steps = np.array([int(f / quantum) if f > 0 else 0 for f in fractions], dtype=np.int64)
+    total_steps = int(total / quantum)
+    if total_steps > MAX_BEAT_STEPS:
+        raise ValueError(f"total_beats={total_beats} needs {total_steps} beat steps (max {MAX_BEAT_STEPS})")
+    return steps, total_steps
+
+# Bump when the on-disk layout of saved models changes
+MODEL_FORMAT = 2
+
+def corpus_hash(corpus_path, extra_melodies=(), order=1, durations="joint"):
+    """
+    Content hash of a training corpus file plus everything else that shapes the model.
+    """
+    digest = hashlib.sha256(f"{MODEL_FORMAT}|{order}|{durations}|".encode("utf-8"))
+    if os.path.exists(corpus_path):
+        with open(corpus_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+    digest.update("\n".join(extra_melodies).encode("utf-8"))
+    return digest.hexdigest()
 
 class MarkovComposer:
-    def __init__(self):
-        self.chain = {}
-        
+    def __init__(self, order=1, durations="joint"):
+        """
+        order: context length in tokens (1-4); lower orders are used as backoff.
+        durations: "joint" treats each "Note:Duration" token as one symbol;
+        "separate" learns independent pitch and duration chains and recombines them.
+        """
+        if not 1 <= order <= 4:
+            raise ValueError("order must be between 1 and 4")
+        if durations not in ("joint", "separate"):
+            raise ValueError("durations must be 'joint' or 'separate'")
+
+        self.order = order
+        self.durations = durations
+        if durations == "joint":
+            self.chains = {"token": TokenChain(order)}
+        else:
+            self.chains = {"pitch": TokenChain(order), "duration": TokenChain(order)}
+
+    @property
+    def num_transitions(self):
+        """
+        Number of distinct learned transitions across all chains and orders.
+        """
+        self.finalize(compact=True)
+        return sum(len(table) for chain in self.chains.values() for table in chain.tables)
+
     def load_data(self):
         """
         Returns a list of simple melodies for training.
@@ -16,44 +567,376 @@ class MarkovComposer:
             "G4 E4 E4 F4 D4 D4 C4 D4 E4 F4 G4 G4 G4"      # Jingle Bellsish
         ]
 
+    @staticmethod
+    def _split_token(token):
+        # "C4:0.5" -> ("C4", "0.5"); a bare note lasts one beat
+        pitch, _, duration = token.partition(":")
+        return pitch, duration or "1"
+
     def train(self, melodies):
         """
-        Builds a Markov Chain from the provided melodies.
-        markov_chain = { 'Note': ['NextPossibleNote1', 'NextPossibleNote2'] }
-        """
-        self.chain = {}
-        for melody in melodies:
-            notes = melody.split()
-            for i in range(len(notes) - 1):
-                current_note = notes[i]
-                next_note = notes[i+1]
-                
-                if current_note not in self.chain:
-                    self.chain[current_note] = []
-                self.chain[current_note].append(next_note)
-                
+        Builds the Markov chains from the provided melodies, replacing anything learned so far.
+        """
+        self.reset()
+        self.partial_train(melodies)
+        self.finalize(compact=True)
+
+    def reset(self):
+        for chain in self.chains.values():
+            chain.reset()
+
+    def partial_train(self, melodies):
+        """
+        Folds more melodies into the existing chains in time proportional to their length.
+        The new transitions are merged in lazily, before the next compose() or save().
+        """
+        tokenized = [melody.split() for melody in melodies]
+        if self.durations == "joint":
+            self.chains["token"].partial_train(tokenized)
+        else:
+            split = [[self._split_token(token) for token in tokens] for tokens in tokenized]
+            self.chains["pitch"].partial_train([pitch for pitch, _ in tokens] for tokens in split)
+            self.chains["duration"].partial_train([duration for _, duration in tokens] for tokens in split)
+
+    def train_stream(self, source, chunk_size=10000):
+        """
+        Trains on a corpus file path or any iterable of melody strings, one line at a time
+        in chunks of chunk_size, so the corpus never has to fit in memory.
+        Adds to the existing chains; call reset() first to start from scratch.
+        Returns the number of melodies read.
+        """
+        f = open(source, "r") if isinstance(source, (str, os.PathLike)) else None
+        try:
+            lines = f if f is not None else source
+            count = 0
+            chunk = []
+            for line in lines:
+                line = line.strip()
+                if not line:
+                    continue
+                chunk.append(line)
+                if len(chunk) >= chunk_size:
+                    self.partial_train(chunk)
+                    count += len(chunk)
+                    chunk = []
+            if chunk:
+                self.partial_train(chunk)
+                count += len(chunk)
+        finally:
+            if f is not None:
+                f.close()
+        self.finalize(compact=True)
+        return count
+
+    def finalize(self, compact=False):
+        """
+        Makes any pending partial_train() data visible to sampling; see TokenChain.finalize.
+        """
+        for chain in self.chains.values():
+            chain.finalize(compact)
+
     def compose(self, start_note=None, length=16):
         """
         Generates a new melody based on the learned chain.
         """
-        if not self.chain:
+        if self.durations == "joint":
+            return " ".join(self.chains["token"].generate(start_note, length))
+
+        start_pitch, start_duration = self._split_token(start_note) if start_note else (None, None)
+        pitches = self.chains["pitch"].generate(start_pitch, length)
+        durations = self.chains["duration"].generate(start_duration, length)
+        if not pitches or not durations:
             return ""
-            
-        # Pick a random starting note if none provided or if invalid
-        if start_note not in self.chain:
-            start_note = random.choice(list(self.chain.keys()))
-            
-        melody = [start_note]
-        current_note = start_note
-        
-        for _ in range(length - 1):
-            if current_note in self.chain:
-                next_note = random.choice(self.chain[current_note])
-                melody.append(next_note)
-                current_note = next_note
+        return " ".join(f"{pitch}:{duration}" for pitch, duration in zip(pitches, durations))
+
+    def compose_batch(self, n, length=16, seed=None, start_note=None):
+        """
+        Generates n melodies at once by advancing n independent chains in lockstep.
+        The same seed always yields the same melodies (for the same trained model).
+        """
+        rng = np.random.default_rng(seed)
+        if self.durations == "joint":
+            chain = self.chains["token"]
+            ids = chain.generate_batch(n, length, rng, start_note)
+            if ids is None:
+                return [""] * n
+            tokens = np.array(chain.vocab, dtype=object)[ids]
+            return [" ".join(row) for row in tokens]
+
+        start_pitch, start_duration = self._split_token(start_note) if start_note else (None, None)
+        pitch_chain, duration_chain = self.chains["pitch"], self.chains["duration"]
+        pitch_ids = pitch_chain.generate_batch(n, length, rng, start_pitch)
+        duration_ids = duration_chain.generate_batch(n, length, rng, start_duration)
+        if pitch_ids is None or duration_ids is None:
+            return [""] * n
+        pitches = np.array(pitch_chain.vocab, dtype=object)[pitch_ids]
+        durations = np.array(duration_chain.vocab, dtype=object)[duration_ids]
+        return [" ".join(f"{pitch}:{duration}" for pitch, duration in zip(*row))
+                for row in zip(pitches, durations)]
+
+    def _joint_space(self):
+        """
+        The model as one chain over (pitch, duration) states, for constrained sampling.
+        Returns (pitches, durations, propagate, context_probs): propagate(G) multiplies the
+        order-1 transition matrix by G, and context_probs(history) yields backoff
+        distributions over the states. In "separate" mode the state space is the product of
+        the two chains and the matrix their Kronecker product, which is never materialized.
+        """
+        if self.durations == "joint":
+            chain = self.chains["token"]
+            split = [self._split_token(token) for token in chain.vocab]
+            matrix = chain.transition_matrix()
+            return ([pitch for pitch, _ in split], [duration for _, duration in split],
+                    lambda G: matrix @ G, chain.context_probs)
+
+        pitch_chain, duration_chain = self.chains["pitch"], self.chains["duration"]
+        n_durations = len(duration_chain.vocab)
+        pitch_matrix = pitch_chain.transition_matrix()
+        duration_matrix = duration_chain.transition_matrix()
+
+        def propagate(G):
+            G = G.reshape(len(pitch_chain.vocab), n_durations, -1)
+            G = np.tensordot(pitch_matrix, G, axes=(1, 0))
+            return (duration_matrix @ G).reshape(-1, G.shape[2])
+
+        def context_probs(history):
+            pitch_probs = list(pitch_chain.context_probs([s // n_durations for s in history]))
+            duration_probs = list(duration_chain.context_probs([s % n_durations for s in history]))
+            if not pitch_probs or not duration_probs:
+                return
+            for k in range(max(len(pitch_probs), len(duration_probs))):
+                yield np.kron(pitch_probs[min(k, len(pitch_probs) - 1)],
+                              duration_probs[min(k, len(duration_probs) - 1)])
+
+        pitches = [pitch for pitch in pitch_chain.vocab for _ in range(n_durations)]
+        durations = duration_chain.vocab * len(pitch_chain.vocab)
+        return pitches, durations, propagate, context_probs
+
+    def compose_constrained(self, length=16, allowed_pitches=None, octave_range=None,
+                            total_beats=None, end_note=None, start_note=None, seed=None):
+        """
+        Generates one melody that meets every given constraint, with no retries:
+        allowed_pitches: pitch classes to use, e.g. ["C", "D", "E", "F", "G", "A", "B"]
+        (a note like "C4" or MIDI number "60" stands for its pitch class);
+        octave_range: (lowest, highest) octave, inclusive;
+        total_beats: exact total duration; with length=None the melody takes as many notes as it needs;
+        end_note: required last note, a pitch class ("C") or an exact note ("C4").
+        A backward pass over the order-1 transitions gives each state's probability of still
+        meeting the constraints; each forward step masks and reweights the (backed-off)
+        transition probabilities by it. Returns "" when the constraints cannot be met.
+        """
+        if length is None and total_beats is None:
+            raise ValueError("length or total_beats is required")
+        pitches, durations, propagate, context_probs = self._joint_space()
+        size = len(pitches)
+        if size == 0:
+            return ""
+
+        unknown = [name for name in list(allowed_pitches or []) + [end_note or "C"] if _pitch_class(name) is None]
+        if unknown:
+            raise ValueError(f"Unknown pitch names: {unknown}")
+        classes = None if allowed_pitches is None else {_pitch_class(name) for name in allowed_pitches}
+        constrained = classes is not None or octave_range is not None
+        numbers = [_pitch_numbers(pitch) for pitch in pitches]
+
+        def pitch_allowed(notes):
+            if notes is None:
+                return not constrained
+            if classes is not None and any(number % 12 not in classes for number in notes):
+                return False
+            if octave_range is not None:
+                low, high = octave_range
+                return all(low <= number // 12 - 1 <= high for number in notes)
+            return True
+
+        ok = np.array([pitch_allowed(notes) for notes in numbers], dtype=bool)
+        if total_beats is not None:
+            steps, total_steps = _beat_steps(durations, total_beats)
+            ok &= steps > 0
+        else:
+            steps, total_steps = np.zeros(size, dtype=np.int64), 0
+
+        final_ok = ok.copy()
+        if end_note is not None:
+            if any(ch.isdigit() for ch in end_note):
+                target = NOTE_NUMBERS[end_note.upper()]
+                final_ok &= np.array([bool(notes) and notes[0] == target for notes in numbers])
             else:
-                # Dead end in chain, pick random restart
-                current_note = random.choice(list(self.chain.keys()))
-                melody.append(current_note)
-                
-        return " ".join(melody)
+                target = PITCH_CLASSES[end_note.upper()]
+                final_ok &= np.array([bool(notes) and notes[0] % 12 == target for notes in numbers])
+
+        width = total_steps + 1
+        def reachable(beta, consumed):
+            # ok[s] * beta[s, consumed + steps[s]], zero past the beat budget
+            columns = consumed + steps
+            weights = np.zeros(size)
+            valid = ok & (columns < width)
+            weights[valid] = beta[valid, columns[valid]]
+            return weights
+
+        # Backward pass: beta[s, b] is the (relative) probability of meeting every
+        # constraint from state s with b beat steps used so far, s included
+        if length is not None:
+            length = max(length, 1)
+            beta = np.zeros((size, width))
+            beta[final_ok, total_steps] = 1.0
+            betas = [beta]
+            for _ in range(length - 1):
+                shifted = np.zeros((size, width))
+                for step in np.unique(steps[ok]):
+                    rows = ok & (steps == step)
+                    shifted[rows, :width - step] = beta[rows, step:]
+                beta = propagate(shifted)
+                peak = beta.max()
+                if peak > 0:
+                    beta /= peak # only ratios within a step matter
+                betas.append(beta)
+            betas.reverse()
+        else:
+            beta = np.zeros((size, width))
+            beta[final_ok, total_steps] = 1.0
+            for consumed in range(total_steps - 1, -1, -1):
+                beta[:, consumed] = propagate(reachable(beta, consumed)[:, None])[:, 0]
+
+        rng = np.random.default_rng(seed)
+        def sample(weights):
+            cumulative = np.cumsum(weights)
+            index = np.searchsorted(cumulative, rng.random() * cumulative[-1], side="right")
+            return int(min(index, size - 1))
+
+        weights = reachable(betas[0] if length is not None else beta, 0)
+        if weights.sum() <= 0:
+            return ""
+        if start_note:
+            start_pitch, start_duration = self._split_token(start_note)
+            candidates = [s for s in range(size) if pitches[s] == start_pitch and durations[s] == start_duration
+                          and weights[s] > 0]
+            current = candidates[0] if candidates else sample(weights)
+        else:
+            current = sample(weights)
+
+        history = [current]
+        consumed = steps[current]
+        while True:
+            if length is not None:
+                if len(history) == length:
+                    break
+                beta = betas[len(history)]
+            elif consumed == total_steps:
+                break
+            weights = reachable(beta, consumed)
+            for probs in context_probs(history):
+                masked = probs * weights
+                if masked.sum() > 0:
+                    break
+            else:
+                return ""
+            current = sample(masked)
+            history.append(current)
+            consumed += steps[current]
+
+        if self.durations == "joint":
+            return " ".join(self.chains["token"].vocab[s] for s in history)
+        return " ".join(f"{pitches[s]}:{durations[s]}" for s in history)
+
+    def save(self, artifact_dir, corpus_hash=""):
+        """
+        Writes the trained model as .npy arrays plus a manifest.json.
+        Every save writes its arrays under a fresh prefix (corpus hash plus a random suffix,
+        recorded in the manifest), so it never rewrites files that other processes may have
+        memory-mapped, even when the corpus hash is unchanged; the manifest is swapped in
+        atomically and the previous save's files are unlinked afterwards. Concurrent saves to
+        one directory are serialized with a lock file so cleanup never removes the files of
+        a save still in progress.
+        """
+        self.finalize(compact=True)
+        os.makedirs(artifact_dir, exist_ok=True)
+        prefix = f"{corpus_hash[:16] or 'model'}-{os.urandom(4).hex()}"
+
+        manifest = {
+            "format": MODEL_FORMAT,
+            "corpus_hash": corpus_hash,
+            "prefix": prefix,
+            "order": self.order,
+            "durations": self.durations,
+            "chains": {},
+        }
+        with open(os.path.join(artifact_dir, ".lock"), "w") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            for name, chain in self.chains.items():
+                manifest["chains"][name] = {
+                    "vocab": chain.vocab,
+                    "radix": [table.radix for table in chain.tables],
+                }
+                for table in chain.tables:
+                    for array in TransitionTable.ARRAYS:
+                        path = os.path.join(artifact_dir, f"{prefix}-{name}-{table.order}-{array}.npy")
+                        np.save(path, getattr(table, array))
+
+            tmp_path = os.path.join(artifact_dir, f"manifest.json.{os.getpid()}.tmp")
+            with open(tmp_path, "w") as f:
+                json.dump(manifest, f)
+            os.replace(tmp_path, os.path.join(artifact_dir, "manifest.json"))
+
+            # Older artifacts can go; unlinking a file that is mapped elsewhere is safe
+            for filename in os.listdir(artifact_dir):
+                if filename.endswith(".npy") and not filename.startswith(prefix + "-"):
+                    try:
+                        os.remove(os.path.join(artifact_dir, filename))
+                    except OSError:
+                        pass
+
+    @classmethod
+    def load(cls, artifact_dir, mmap=True):
+        """
+        Loads a saved model. With mmap=True the arrays are read-only memory maps, so every
+        session and worker process shares one copy through the page cache.
+        Returns (composer, corpus_hash).
+        """
+        with open(os.path.join(artifact_dir, "manifest.json")) as f:
+            manifest = json.load(f)
+        if manifest.get("format") != MODEL_FORMAT:
+            raise ValueError(f"Unsupported model format {manifest.get('format')}")
+
+        composer = cls(order=manifest["order"], durations=manifest["durations"])
+        prefix = manifest["prefix"]
+        for name, chain in composer.chains.items():
+            saved = manifest["chains"][name]
+            chain.vocab = saved["vocab"]
+            chain.index = {token: token_id for token_id, token in enumerate(chain.vocab)}
+            for table, radix in zip(chain.tables, saved["radix"]):
+                arrays = {
+                    array: np.load(os.path.join(artifact_dir, f"{prefix}-{name}-{table.order}-{array}.npy"),
+                                   mmap_mode="r" if mmap else None)
+                    for array in TransitionTable.ARRAYS
+                }
+                table.load_arrays(arrays, radix)
+        return composer, manifest["corpus_hash"]
+
+    @classmethod
+    def load_or_train(cls, corpus_path, artifact_dir, order=1, durations="joint", include_defaults=True):
+        """
+        Loads the model saved in artifact_dir if it was built from the current corpus
+        (by content hash); otherwise trains on the corpus file (plus the built-in melodies)
+        and saves a fresh artifact.
+        """
+        defaults = cls().load_data() if include_defaults else []
+        expected_hash = corpus_hash(corpus_path, defaults, order, durations)
+
+        try:
+            composer, saved_hash = cls.load(artifact_dir)
+            if saved_hash == expected_hash:
+                return composer
+        except (OSError, ValueError, KeyError):
+            pass
+
+        composer = cls(order=order, durations=durations)
+        if os.path.exists(corpus_path):
+            composer.train_stream(corpus_path)
+        composer.partial_train(defaults)
+        try:
+            composer.save(artifact_dir, expected_hash)
+        except OSError as e:
+            print(f"Could not save Markov model: {e}")
+        return composer
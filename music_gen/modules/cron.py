@@ -3,11 +3,15 @@ import os
 import time
 from apscheduler.schedulers.background import BackgroundScheduler
 from datetime import datetime, timedelta
+from .history import generation_times, mark_files_deleted
+from .render_cache import CACHE_DIR
 
 def cleanup_old_files():
     """
     Deletes files in music_gen/generated that are older than 1 day.
-    Ignores subdirectories to be safe, or handles them if we structure by user.
+    Files a generation records are aged by its created_at: saved WAVs are hard links to
+    shared render cache blobs, and every cache hit refreshes the shared inode's times.
+    Anything else (e.g. left by a save job that failed before its insert) goes by ctime.
     """
     OUTPUT_DIR = "music_gen/generated"
     if not os.path.exists(OUTPUT_DIR):
@@ -15,18 +19,34 @@ def cleanup_old_files():
 
     # print(f"[{datetime.now()}] Running cleanup...")
     current_time = time.time()
+    deleted = []
     
     # Walk through all directories in generated/
+    candidates = []
     for root, dirs, files in os.walk(OUTPUT_DIR):
-        for f in files:
-            file_path = os.path.join(root, f)
-            try:
-                creation_time = os.path.getctime(file_path)
-                if (current_time - creation_time) > 86400: # 1 day
-                    os.remove(file_path)
-                    print(f"Deleted old file: {file_path}")
-            except Exception as e:
-                print(f"Error cleaning {file_path}: {e}")
+        # The render cache bounds its own size (RenderCache._evict_disk)
+        dirs[:] = [d for d in dirs if os.path.join(root, d) != os.path.normpath(CACHE_DIR)]
+        candidates.extend((f, os.path.join(root, f)) for f in files)
+
+    created = generation_times(f for f, _ in candidates)
+    cutoff = datetime.utcnow() - timedelta(days=1)
+    for f, file_path in candidates:
+        try:
+            if f in created:
+                old = created[f] < cutoff
+            else:
+                old = (current_time - os.path.getctime(file_path)) > 86400 # 1 day
+            if old:
+                os.remove(file_path)
+                deleted.append(f)
+                print(f"Deleted old file: {file_path}")
+        except Exception as e:
+            print(f"Error cleaning {file_path}: {e}")
+
+    # Record it in the DB, so the history never has to probe the filesystem
+    if deleted:
+        marked = mark_files_deleted(deleted)
+        print(f"Marked {marked} generation(s) as deleted")
 
 def start_scheduler():
     scheduler = BackgroundScheduler()
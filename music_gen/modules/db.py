@@ -1,5 +1,6 @@
 
-from sqlalchemy import create_engine, Column, Integer, String, DateTime
+from contextlib import contextmanager
+from sqlalchemy import create_engine, event, make_url, inspect, text, Column, Integer, String, DateTime, Index
 from sqlalchemy.orm import declarative_base, sessionmaker
 from datetime import datetime
 import os
@@ -16,25 +17,106 @@ class User(Base):
 
 class Generation(Base):
     __tablename__ = 'generations'
+    # History is always "this user's newest first"; SQLite appends the rowid (id) to every
+    # index entry, so this also serves ORDER BY created_at, id
+    __table_args__ = (Index('ix_generations_user_created', 'user_id', 'created_at'),)
     
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, nullable=False) # Foreign key logic handled manually or via simple ID for now
     filename = Column(String, nullable=False)
     image_filename = Column(String, nullable=True) # New column for saving visualization
+    peaks_filename = Column(String, nullable=True) # Min/max peaks sidecar (see modules/peaks.py)
     prompt = Column(String, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
+    files_deleted_at = Column(DateTime, nullable=True) # Set by the cleanup job once the files are removed
 
 # Ensure data directory exists
 # Assuming run from root, so music_gen/data is correct
 if not os.path.exists("music_gen/data"):
     os.makedirs("music_gen/data", exist_ok=True)
 
+# Connection settings, overridable from the environment
+DATABASE_URL = os.environ.get("MUSIC_GEN_DB_URL", "sqlite:///music_gen/data/app.db")
+POOL_SIZE = int(os.environ.get("MUSIC_GEN_DB_POOL_SIZE", 5))
+MAX_OVERFLOW = int(os.environ.get("MUSIC_GEN_DB_MAX_OVERFLOW", 10))
+POOL_TIMEOUT = float(os.environ.get("MUSIC_GEN_DB_POOL_TIMEOUT", 30))
+
+def make_engine(url=DATABASE_URL, pool_size=POOL_SIZE, max_overflow=MAX_OVERFLOW, pool_timeout=POOL_TIMEOUT):
+    """
+    Pooled engine for url. SQLite connections are switched to WAL so the background save
+    jobs can write while page reruns read, with synchronous=NORMAL (durable at checkpoints,
+    no fsync per commit). The pool settings apply wherever SQLAlchemy uses a QueuePool,
+    i.e. everything but in-memory SQLite, which keeps its single shared connection.
+    """
+    parsed = make_url(url)
+    kwargs = {}
+    if parsed.get_backend_name() == "sqlite":
+        kwargs["connect_args"] = {'check_same_thread': False}
+    if parsed.get_backend_name() != "sqlite" or parsed.database not in (None, "", ":memory:"):
+        kwargs.update(pool_size=pool_size, max_overflow=max_overflow, pool_timeout=pool_timeout)
+    engine = create_engine(url, **kwargs)
+    if engine.dialect.name == "sqlite":
+        @event.listens_for(engine, "connect")
+        def set_sqlite_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute("PRAGMA synchronous=NORMAL")
+            cursor.close()
+    return engine
+
 # Connect to SQLite
-engine = create_engine('sqlite:///music_gen/data/app.db', connect_args={'check_same_thread': False})
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+engine = make_engine()
+# Rows stay readable after the session closes, so pages can render them outside session_scope
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine)
 
 def init_db():
     Base.metadata.create_all(bind=engine)
+    add_missing_columns()
+    add_missing_indexes()
+
+def add_missing_columns():
+    """
+    create_all() never alters existing tables, so databases created by an older version
+    get any newly added (nullable) columns here.
+    """
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            column_type = column.type.compile(dialect=engine.dialect)
+            with engine.begin() as conn:
+                conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+            print(f"Added column {table.name}.{column.name}")
+
+def add_missing_indexes():
+    """
+    Likewise, create_all() only builds indexes together with a new table.
+    """
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existing = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(bind=engine)
+                print(f"Created index {index.name}")
+
+@contextmanager
+def session_scope():
+    """
+    A session that commits when the block succeeds, rolls back when it raises, and is
+    always returned to the pool.
+    """
+    db = SessionLocal()
+    try:
+        yield db
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
 
 def get_db():
     db = SessionLocal()
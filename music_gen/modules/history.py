@@ -0,0 +1,133 @@
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+from sqlalchemy import tuple_
+
+from .db import Generation, session_scope
+
+HISTORY_PAGE_SIZE = 10
+
+def query_page(db, user_id, before=None, limit=HISTORY_PAGE_SIZE):
+    """
+    One page of a user's generations, newest first, using keyset pagination: `before` is
+    the (created_at, id) of the last row of the previous page. Every page is a range seek
+    on ix_generations_user_created, however far back it is.
+    Returns (rows, next_cursor); next_cursor is None on the last page.
+    """
+    query = db.query(Generation).filter(Generation.user_id == user_id)
+    if before is not None:
+        query = query.filter(tuple_(Generation.created_at, Generation.id) < tuple_(*before))
+    rows = query.order_by(Generation.created_at.desc(), Generation.id.desc()).limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = (rows[-1].created_at, rows[-1].id)
+    return rows, next_cursor
+
+def _snapshot(item):
+    # Plain dicts, so cached pages are safe to share between sessions and threads
+    return {
+        "id": item.id,
+        "filename": item.filename,
+        "image_filename": item.image_filename,
+        "peaks_filename": item.peaks_filename,
+        "prompt": item.prompt,
+        "created_at": item.created_at,
+        "available": item.files_deleted_at is None,
+    }
+
+class HistoryCache:
+    """
+    Per-user cache of history pages so reruns (slider moves, playback) don't hit the
+    database. A user's pages are dropped whenever their generations change; at most
+    max_users users are kept, least recently used evicted first.
+    """
+    def __init__(self, max_users=256):
+        self.max_users = max_users
+        self._pages = OrderedDict()
+        self._version = 0
+        self._lock = threading.Lock()
+
+    def page(self, user_id, before=None, limit=HISTORY_PAGE_SIZE):
+        """
+        Cached query_page() as (list of row dicts, next_cursor).
+        """
+        key = (before, limit)
+        with self._lock:
+            pages = self._pages.get(user_id)
+            if pages is not None and key in pages:
+                self._pages.move_to_end(user_id)
+                return pages[key]
+            version = self._version
+
+        with session_scope() as db:
+            rows, next_cursor = query_page(db, user_id, before, limit)
+            result = ([_snapshot(item) for item in rows], next_cursor)
+
+        with self._lock:
+            # An invalidation while we were querying may have made this page stale
+            if version == self._version:
+                self._pages.setdefault(user_id, {})[key] = result
+                self._pages.move_to_end(user_id)
+                while len(self._pages) > self.max_users:
+                    self._pages.popitem(last=False)
+        return result
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._version += 1
+            self._pages.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._version += 1
+            self._pages.clear()
+
+# Shared by every session in the process
+history_cache = HistoryCache()
+
+def generation_times(filenames, chunk_size=500):
+    """
+    {basename: created_at} for those of these files (WAV, PNG or peaks basenames) that a
+    generation records.
+    """
+    filenames = list(filenames)
+    times = {}
+    with session_scope() as db:
+        for start in range(0, len(filenames), chunk_size):
+            chunk = filenames[start:start + chunk_size]
+            wanted = set(chunk)
+            rows = db.query(Generation.filename, Generation.image_filename, Generation.peaks_filename,
+                            Generation.created_at).filter(
+                Generation.filename.in_(chunk) | Generation.image_filename.in_(chunk) | Generation.peaks_filename.in_(chunk),
+            ).all()
+            for *names, created_at in rows:
+                for name in names:
+                    if name in wanted:
+                        times[name] = created_at
+    return times
+
+def mark_files_deleted(filenames, chunk_size=500):
+    """
+    Records that the generations owning any of these files (WAV, PNG or peaks basenames)
+    no longer have them on disk. Returns the number of generations marked.
+    """
+    filenames = list(filenames)
+    now = datetime.utcnow()
+    user_ids = set()
+    marked = 0
+    with session_scope() as db:
+        for start in range(0, len(filenames), chunk_size):
+            chunk = filenames[start:start + chunk_size]
+            rows = db.query(Generation).filter(
+                Generation.files_deleted_at.is_(None),
+                Generation.filename.in_(chunk) | Generation.image_filename.in_(chunk) | Generation.peaks_filename.in_(chunk),
+            ).all()
+            for item in rows:
+                item.files_deleted_at = now
+                user_ids.add(item.user_id)
+            marked += len(rows)
+    for user_id in user_ids:
+        history_cache.invalidate(user_id)
+    return marked
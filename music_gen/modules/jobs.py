@@ -0,0 +1,74 @@
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+class JobQueue:
+    """
+    Runs slow work (file writes, image encoding, DB commits) on a thread pool so the
+    Streamlit script thread can return immediately. Every job gets an id whose status can
+    be polled from any rerun or session. Finished jobs are kept for status queries until
+    more than max_finished have accumulated, oldest dropped first.
+    """
+    def __init__(self, max_workers=4, max_finished=1000):
+        self.max_finished = max_finished
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Queues fn(*args, **kwargs) and returns its job id.
+        """
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            self._jobs[job_id] = {"status": QUEUED, "result": None, "error": None}
+        self._executor.submit(self._run, job_id, fn, args, kwargs)
+        return job_id
+
+    def _run(self, job_id, fn, args, kwargs):
+        self._update(job_id, status=RUNNING)
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            print(f"Job {job_id} failed: {e}")
+            self._update(job_id, status=FAILED, error=str(e))
+        else:
+            self._update(job_id, status=DONE, result=result)
+        self._trim()
+
+    def _update(self, job_id, **fields):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                job.update(fields)
+
+    def _trim(self):
+        with self._lock:
+            finished = [job_id for job_id, job in self._jobs.items() if job["status"] in (DONE, FAILED)]
+            for job_id in finished[:max(0, len(finished) - self.max_finished)]:
+                del self._jobs[job_id]
+
+    def status(self, job_id):
+        """
+        Snapshot {"status", "result", "error"} of a job, or None for an unknown id.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def pending(self, job_ids):
+        """
+        The ids among job_ids that are still queued or running.
+        """
+        with self._lock:
+            return [job_id for job_id in job_ids
+                    if job_id in self._jobs and self._jobs[job_id]["status"] in (QUEUED, RUNNING)]
+
+# Shared by every session in the process
+job_queue = JobQueue()
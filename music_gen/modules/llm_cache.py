@@ -0,0 +1,184 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+CACHE_PATH = "music_gen/data/llm_cache.db"
+
+class LLMCache:
+    """
+    Persistent cache of LLM responses in SQLite, keyed by everything that shapes the reply.
+    Entries expire after ttl_seconds and the table is trimmed to max_entries, least
+    recently used first. Identical requests made while one is already in flight wait for
+    its result instead of calling the model again.
+    """
+    def __init__(self, path=CACHE_PATH, ttl_seconds=7 * 24 * 3600, max_entries=10000):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+
+        self._conn = None
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self._in_flight_lock = threading.Lock()
+
+    @staticmethod
+    def key(model_name, system_prompt, user_message, temperature):
+        parts = [model_name, system_prompt, user_message, temperature]
+        return hashlib.sha256(json.dumps(parts).encode("utf-8")).hexdigest()
+
+    def _connection(self):
+        # One shared connection, created on first use; callers hold self._lock
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, content TEXT NOT NULL, "
+                "created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS ix_responses_accessed ON responses (accessed_at)")
+            self._conn.commit()
+        return self._conn
+
+    def get(self, key):
+        """
+        Cached content for key, or None if missing or expired.
+        """
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            row = conn.execute("SELECT content, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            content, created_at = row
+            if now - created_at > self.ttl_seconds:
+                conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                conn.commit()
+                return None
+            conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+            conn.commit()
+            return content
+
+    def put(self, key, content):
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)", (key, content, now, now))
+            conn.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl_seconds,))
+            conn.execute(
+                "DELETE FROM responses WHERE key IN ("
+                "SELECT key FROM responses ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            conn.commit()
+
+    def _claim(self, key, loop=None):
+        # Returns (waiter, is_leader, future); the leader must call _release when done.
+        # Async followers pass their event loop and get a future to await instead of
+        # blocking on the event, so they never tie up executor threads.
+        with self._in_flight_lock:
+            waiter = self._in_flight.get(key)
+            if waiter is None:
+                waiter = self._in_flight[key] = {"done": threading.Event(), "futures": []}
+                return waiter, True, None
+            future = None
+            if loop is not None:
+                future = loop.create_future()
+                waiter["futures"].append((loop, future))
+            return waiter, False, future
+
+    def _release(self, key, waiter):
+        with self._in_flight_lock:
+            del self._in_flight[key]
+            waiter["done"].set()
+        for loop, future in waiter["futures"]:
+            loop.call_soon_threadsafe(lambda future=future: future.done() or future.set_result(None))
+
+    @staticmethod
+    def _outcome(waiter):
+        # Content the leader produced, raising its error; None if it was cancelled
+        if "error" in waiter:
+            raise waiter["error"]
+        return waiter.get("content")
+
+    def get_or_compute(self, key, compute, store=True):
+        """
+        Returns the cached content for key, or calls compute() once and caches its result.
+        Concurrent callers with the same key share a single compute() call; if it raises,
+        they all see the exception and nothing is cached. With store=False the result is
+        shared but not cached, leaving the caller to put() it once it has checked it.
+        """
+        while True:
+            content = self.get(key)
+            if content is not None:
+                return content
+
+            waiter, leader, _ = self._claim(key)
+            if not leader:
+                waiter["done"].wait()
+                content = self._outcome(waiter)
+                if content is not None:
+                    return content
+                continue # the leader was cancelled; try again
+
+            try:
+                content = self.get(key)
+                if content is None:
+                    content = compute()
+                    if store:
+                        self.put(key, content)
+                waiter["content"] = content
+                return content
+            except Exception as e:
+                waiter["error"] = e
+                raise
+            finally:
+                self._release(key, waiter)
+
+    async def aget_or_compute(self, key, acompute, store=True):
+        """
+        Async get_or_compute(): acompute is awaited by one caller per key, and sync and
+        async callers coalesce with each other. A leader that is cancelled (e.g. by a
+        timeout) does not fail its followers; one of them takes over instead.
+        """
+        while True:
+            content = self.get(key)
+            if content is not None:
+                return content
+
+            waiter, leader, future = self._claim(key, asyncio.get_running_loop())
+            if not leader:
+                await future
+                content = self._outcome(waiter)
+                if content is not None:
+                    return content
+                continue
+
+            try:
+                content = self.get(key)
+                if content is None:
+                    content = await acompute()
+                    if store:
+                        self.put(key, content)
+                waiter["content"] = content
+                return content
+            except Exception as e:
+                waiter["error"] = e
+                raise
+            finally:
+                self._release(key, waiter)
+
+    def clear(self):
+        with self._lock:
+            conn = self._connection()
+            conn.execute("DELETE FROM responses")
+            conn.commit()
+
+# Shared by every agent in the process
+llm_cache = LLMCache()
@@ -0,0 +1,98 @@
+import struct
+
+import numpy as np
+
+# Binary peaks sidecar, little-endian:
+#   header  "MGPK", version u16, sample_rate u32, total_samples u64, base_block u32, levels u16
+#   counts  one u64 column count per level
+#   data    per level, finest first: count (min, max) int16 pairs
+# Level k summarizes base_block * 2**k samples per column.
+PEAKS_MAGIC = b"MGPK"
+PEAKS_VERSION = 1
+HEADER = struct.Struct("<4sHIQIH")
+
+BASE_BLOCK = 128
+MIN_COLUMNS = 64
+
+def _reduce(mins, maxs, edges):
+    return np.minimum.reduceat(mins, edges), np.maximum.reduceat(maxs, edges)
+
+def build_levels(audio, base_block=BASE_BLOCK, min_columns=MIN_COLUMNS):
+    """
+    Min/max pyramid of the signal: a list of (mins, maxs) arrays, finest first, each level
+    halving the previous one until it has at most min_columns columns.
+    """
+    if len(audio) == 0:
+        return []
+    levels = [_reduce(audio, audio, np.arange(0, len(audio), base_block))]
+    while len(levels[-1][0]) > min_columns:
+        mins, maxs = levels[-1]
+        levels.append(_reduce(mins, maxs, np.arange(0, len(mins), 2)))
+    return levels
+
+def write_peaks(path, audio, sample_rate, base_block=BASE_BLOCK):
+    """
+    Writes the peaks sidecar for int16 audio. Returns the number of bytes written.
+    """
+    levels = build_levels(np.asarray(audio, dtype=np.int16), base_block)
+    with open(path, "wb") as f:
+        f.write(HEADER.pack(PEAKS_MAGIC, PEAKS_VERSION, sample_rate, len(audio), base_block, len(levels)))
+        f.write(np.array([len(mins) for mins, _ in levels], dtype="<u8").tobytes())
+        for mins, maxs in levels:
+            f.write(np.column_stack((mins, maxs)).astype("<i2").tobytes())
+        return f.tell()
+
+class Peaks:
+    """
+    A loaded peaks sidecar. columns() answers any width in O(width) from the pyramid,
+    without the audio samples.
+    """
+    def __init__(self, sample_rate, total_samples, base_block, levels):
+        self.sample_rate = sample_rate
+        self.total_samples = total_samples
+        self.base_block = base_block
+        self.levels = levels
+
+    @property
+    def duration(self):
+        return self.total_samples / self.sample_rate if self.sample_rate else 0.0
+
+    @classmethod
+    def read(cls, path):
+        with open(path, "rb") as f:
+            data = f.read()
+        magic, version, sample_rate, total_samples, base_block, n_levels = HEADER.unpack_from(data)
+        if magic != PEAKS_MAGIC or version != PEAKS_VERSION:
+            raise ValueError(f"{path} is not a version {PEAKS_VERSION} peaks file")
+
+        offset = HEADER.size
+        counts = np.frombuffer(data, dtype="<u8", count=n_levels, offset=offset)
+        offset += counts.nbytes
+        levels = []
+        for count in counts.tolist():
+            pairs = np.frombuffer(data, dtype="<i2", count=2 * count, offset=offset).reshape(-1, 2)
+            offset += pairs.nbytes
+            levels.append((pairs[:, 0], pairs[:, 1]))
+        return cls(sample_rate, total_samples, base_block, levels)
+
+    def columns(self, width, start=0, end=None):
+        """
+        (mins, maxs) for samples [start, end) in at most `width` columns, taken from the
+        coarsest level that still has a column per pixel.
+        """
+        end = self.total_samples if end is None else min(end, self.total_samples)
+        if not self.levels or end <= start:
+            empty = np.empty(0, dtype=np.int16)
+            return empty, empty
+
+        span = end - start
+        level = 0
+        while level + 1 < len(self.levels) and span / (self.base_block << (level + 1)) >= width:
+            level += 1
+        block = self.base_block << level
+        mins, maxs = self.levels[level]
+        lo, hi = start // block, -(-end // block)
+        mins, maxs = mins[lo:hi], maxs[lo:hi]
+
+        count = min(width, len(mins))
+        return _reduce(mins, maxs, (np.arange(count, dtype=np.int64) * len(mins)) // count)
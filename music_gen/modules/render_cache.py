@@ -0,0 +1,183 @@
+import hashlib
+import os
+import shutil
+import threading
+import wave
+from collections import OrderedDict
+
+import numpy as np
+
+from .synthesizer import WavWriter, split_tracks
+
+# Bump when the synthesizer's output changes so stale blobs are never served
+RENDER_VERSION = 1
+
+CACHE_DIR = "music_gen/generated/.render_cache"
+
+def normalize_sequence(note_sequence):
+    """
+    Canonical form of a note string for cache keys: one space between tokens,
+    ' | ' between tracks, upper-case notes and explicit float durations.
+    Strings that render identically ("c4 d4:1.0" and "C4:1  D4:1") normalize identically.
+    """
+    tracks = []
+    for tokens in split_tracks(note_sequence):
+        normalized = []
+        for token in tokens:
+            if token.count(':') > 1:
+                # Malformed; keep as-is so it still fails to render
+                normalized.append(token)
+                continue
+            note_str, _, duration_str = token.partition(':')
+            try:
+                duration = float(duration_str) if duration_str else 1.0
+            except ValueError:
+                duration = 1.0
+            normalized.append(f"{note_str.upper()}:{duration!r}")
+        tracks.append(" ".join(normalized))
+    return " | ".join(tracks)
+
+def _read_wav(path):
+    with wave.open(path, "rb") as f:
+        return np.frombuffer(f.readframes(f.getnframes()), dtype="<i2")
+
+class RenderCache:
+    """
+    Content-addressed cache of rendered melodies.
+    Keys hash the normalized note sequence and every setting that affects the samples.
+    Results live in a size-bounded in-memory LRU and as int16 WAV blobs on disk, also
+    evicted by total size. Cached arrays are shared and read-only.
+    """
+    def __init__(self, cache_dir=CACHE_DIR, max_memory_bytes=64 * 1024 * 1024,
+                 max_disk_bytes=512 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+
+    def key(self, synth, note_sequence, bpm=120, wave_type='sine'):
+        parts = [
+            RENDER_VERSION, normalize_sequence(note_sequence), float(bpm), wave_type,
+            synth.sample_rate, synth.attack, synth.decay, synth.sustain_level, synth.release,
+            synth.pulse_width, synth.dtype.str,
+        ]
+        return hashlib.sha256(repr(parts).encode("utf-8")).hexdigest()
+
+    def blob_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.wav")
+
+    def render(self, synth, note_sequence, bpm=120, wave_type='sine'):
+        """
+        Returns (audio, key). audio is None when the sequence has no notes,
+        exactly like Synthesizer.generate_audio.
+        """
+        key = self.key(synth, note_sequence, bpm, wave_type)
+
+        audio = self._get_memory(key)
+        if audio is not None:
+            return audio, key
+
+        path = self.blob_path(key)
+        try:
+            audio = _read_wav(path)
+            os.utime(path) # mark as recently used for disk eviction
+        except (FileNotFoundError, wave.Error, EOFError):
+            audio = synth.generate_audio(note_sequence, bpm=bpm, wave_type=wave_type)
+            if audio is None:
+                return None, key
+            self._write_blob(path, audio, synth.sample_rate)
+
+        audio.flags.writeable = False
+        self._put_memory(key, audio)
+        return audio, key
+
+    def save_to(self, key, dest_path, audio, sample_rate):
+        """
+        Places the rendered WAV at dest_path. The disk blob is hard-linked when possible,
+        so identical renders are stored once however many users keep them. The link shares
+        the blob's inode, whose times every cache hit refreshes, so the cleanup job ages
+        such files by their generation's created_at rather than by the filesystem.
+        key may be None for audio that was not rendered through the cache.
+        """
+        blob = self.blob_path(key) if key else None
+        if blob and os.path.exists(blob):
+            try:
+                os.link(blob, dest_path)
+                return dest_path
+            except OSError:
+                try:
+                    shutil.copyfile(blob, dest_path)
+                    return dest_path
+                except OSError:
+                    pass
+        with WavWriter(dest_path, sample_rate) as writer:
+            writer.write(audio)
+        return dest_path
+
+    def clear_memory(self):
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+
+    def _get_memory(self, key):
+        with self._lock:
+            audio = self._memory.get(key)
+            if audio is not None:
+                self._memory.move_to_end(key)
+            return audio
+
+    def _put_memory(self, key, audio):
+        if audio.nbytes > self.max_memory_bytes:
+            return
+        with self._lock:
+            if key in self._memory:
+                return
+            self._memory[key] = audio
+            self._memory_bytes += audio.nbytes
+            while self._memory_bytes > self.max_memory_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_bytes -= evicted.nbytes
+
+    def _write_blob(self, path, audio, sample_rate):
+        if audio.nbytes > self.max_disk_bytes:
+            return
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # Write then rename so readers never see a half-written blob
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with WavWriter(tmp_path, sample_rate) as writer:
+                writer.write(audio)
+            os.replace(tmp_path, path)
+            self._evict_disk()
+        except OSError as e:
+            print(f"Render cache write failed: {e}")
+
+    def _evict_disk(self):
+        """
+        Deletes least recently used blobs until the cache directory fits max_disk_bytes.
+        """
+        entries = []
+        total = 0
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if not entry.name.endswith(".wav"):
+                    continue
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+# Shared by every session in the process
+render_cache = RenderCache()
@@ -1,132 +1,547 @@
 
 import numpy as np
-from scipy.io.wavfile import write
-from scipy import signal
+import struct
+from itertools import chain
+from collections import OrderedDict
+from functools import lru_cache
+
+WAVE_TYPES = ['sine', 'square', 'sawtooth', 'triangle', 'pulse']
+
+# Note grammar: "C4:1" is a single note, "C4+E4+G4:1" a chord, and '|' separates
+# tracks that play in parallel (e.g. "C4:1 E4:1 G4:2 | C3:4").
+CHORD_SEPARATOR = '+'
+TRACK_SEPARATOR = '|'
+
+# Pitch class spellings (sharps, flats and enharmonics) as semitones above C
+PITCH_CLASSES = {
+    'C': 0, 'B#': 0, 'C#': 1, 'DB': 1, 'D': 2, 'D#': 3, 'EB': 3, 'E': 4, 'FB': 4,
+    'F': 5, 'E#': 5, 'F#': 6, 'GB': 6, 'G': 7, 'G#': 8, 'AB': 8, 'A': 9, 'A#': 10,
+    'BB': 10, 'B': 11, 'CB': 11,
+}
+SHARP_NAMES = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
+
+def _build_note_table():
+    """
+    Maps every upper-cased pitch spelling to its MIDI number: 'C4', 'BB3' (Bb3), 'B#3' (= C4),
+    bare names (octave 4) for octaves 0-9, and plain MIDI numbers '0'-'127'.
+    """
+    table = {str(midi): midi for midi in range(128)}
+    for octave in range(10):
+        for name, semitone in PITCH_CLASSES.items():
+            # B#/Cb cross the octave boundary: B#3 is C4, Cb4 is B3
+            shift = 12 if name == 'B#' else -12 if name == 'CB' else 0
+            table[f"{name}{octave}"] = 12 * (octave + 1) + semitone + shift
+    for name, semitone in PITCH_CLASSES.items():
+        table.setdefault(name, table[f"{name}4"])
+    return table
+
+# Built once per process and shared by every Synthesizer
+NOTE_NUMBERS = _build_note_table()
+NOTE_FREQUENCIES = {name: 440.0 * 2 ** ((midi - 69) / 12) for name, midi in NOTE_NUMBERS.items()}
+
+def split_tracks(note_sequence):
+    """
+    Splits a note string into its tracks, each a list of tokens. Empty tracks are dropped.
+    """
+    tracks = [track.split() for track in note_sequence.split(TRACK_SEPARATOR)]
+    return [tokens for tokens in tracks if tokens]
+
+# Wavetable oscillator bank: one single-cycle table per octave band, each holding only the
+# harmonics that stay below Nyquist for every frequency in that band.
+TABLE_SIZE = 4096
+LOWEST_FREQ = 8.175798915643707 # C-1 (MIDI note 0), bottom of the first octave band
+
+def _band_count(sample_rate):
+    return max(1, int(np.ceil(np.log2(sample_rate / 2 / LOWEST_FREQ))))
+
+@lru_cache(maxsize=None)
+def get_wavetables(wave_type, sample_rate, pulse_width=0.5, dtype=np.float64):
+    """
+    Returns a read-only (bands, TABLE_SIZE + 1) array of band-limited single-cycle tables.
+    The extra column repeats the first sample so linear interpolation never wraps.
+    Tables are built once per process and shared by every Synthesizer.
+    """
+    nyquist = sample_rate / 2
+    n_bands = _band_count(sample_rate)
+    harmonics = np.arange(1, TABLE_SIZE // 2)
+    
+    # Fourier series as cosine (a) and sine (b) coefficients
+    if wave_type == 'square':
+        a = np.zeros(len(harmonics))
+        b = np.where(harmonics % 2 == 1, 4 / (np.pi * harmonics), 0.0)
+    elif wave_type == 'sawtooth':
+        # Rising ramp from -1 to 1, same phase as scipy.signal.sawtooth
+        a = np.zeros(len(harmonics))
+        b = -2 / (np.pi * harmonics)
+    elif wave_type == 'triangle':
+        a = np.zeros(len(harmonics))
+        signs = np.where((harmonics // 2) % 2 == 0, 1.0, -1.0)
+        b = np.where(harmonics % 2 == 1, signs * 8 / (np.pi * harmonics) ** 2, 0.0)
+    elif wave_type == 'pulse':
+        # High for the first pulse_width of the cycle, DC removed
+        a = 2 * np.sin(2 * np.pi * harmonics * pulse_width) / (np.pi * harmonics)
+        b = 2 * (1 - np.cos(2 * np.pi * harmonics * pulse_width)) / (np.pi * harmonics)
+    else:
+        a = np.zeros(len(harmonics))
+        b = np.where(harmonics == 1, 1.0, 0.0)
+        
+    tables = np.empty((n_bands, TABLE_SIZE + 1))
+    for band in range(n_bands):
+        band_top = LOWEST_FREQ * 2 ** (band + 1)
+        audible = harmonics * band_top < nyquist
+        audible[0] = True # always keep the fundamental
+        
+        spectrum = np.zeros(TABLE_SIZE // 2 + 1, dtype=complex)
+        spectrum[1:TABLE_SIZE // 2] = np.where(audible, a - 1j * b, 0) * (TABLE_SIZE / 2)
+        table = np.fft.irfft(spectrum, TABLE_SIZE)
+        
+        # Unit peak keeps every waveform in the same [-1, 1] range despite Gibbs overshoot
+        table /= np.max(np.abs(table))
+        tables[band, :TABLE_SIZE] = table
+        tables[band, TABLE_SIZE] = table[0]
+        
+    tables = tables.astype(dtype, copy=False)
+    tables.flags.writeable = False
+    return tables
+
+class WavWriter:
+    """
+    Incremental 16-bit PCM WAV writer.
+    Blocks are appended as they arrive; the RIFF and data chunk sizes are patched on close.
+    Accepts a path or a seekable binary file object.
+    """
+    HEADER_SIZE = 44
+
+    def __init__(self, file, sample_rate, channels=1):
+        self._owns_file = isinstance(file, (str, bytes)) or hasattr(file, "__fspath__")
+        self.file = open(file, "wb") if self._owns_file else file
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.frames = 0
+        self._start = self.file.tell()
+        self._write_header(0)
+
+    def _write_header(self, data_size):
+        block_align = self.channels * 2
+        self.file.write(struct.pack(
+            "<4sI4s4sIHHIIHH4sI",
+            b"RIFF", 36 + data_size, b"WAVE",
+            b"fmt ", 16, 1, self.channels, self.sample_rate,
+            self.sample_rate * block_align, block_align, 16,
+            b"data", data_size,
+        ))
+
+    def write(self, block):
+        data = np.asarray(block).astype("<i2", copy=False)
+        self.file.write(data.tobytes())
+        self.frames += len(data) // self.channels
+
+    def close(self):
+        if self.file is None:
+            return
+        end = self.file.tell()
+        self.file.seek(self._start)
+        self._write_header(end - self._start - self.HEADER_SIZE)
+        self.file.seek(end)
+        if self._owns_file:
+            self.file.close()
+        self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
 
 class Synthesizer:
-    def __init__(self, sample_rate=44100):
+    # Samples rendered per vectorized block; small enough that the temporaries stay in cache
+    block_size = 16384
+
+    def __init__(self, sample_rate=44100, attack=0.1, decay=0.1, sustain_level=0.7, release=0.2,
+                 envelope_cache_size=32, pulse_width=0.25, dtype=np.float32):
+        """
+        attack, decay and release are fractions of each note's length; the sustain
+        phase fills whatever is left at sustain_level.
+        pulse_width is the duty cycle used by the 'pulse' oscillator.
+        dtype is the float type of the signal path; float32 halves memory traffic,
+        float64 reproduces the original double-precision render.
+        """
+        if min(attack, decay, release) < 0 or attack + decay + release > 1:
+            raise ValueError("attack, decay and release must be non-negative fractions summing to at most 1")
+        if not 0 <= sustain_level <= 1:
+            raise ValueError("sustain_level must be between 0 and 1")
+        if not 0 < pulse_width < 1:
+            raise ValueError("pulse_width must be between 0 and 1")
+            
         self.sample_rate = sample_rate
-        # Basic frequencies for the 4th octave (A4 = 440Hz)
-        self.note_freqs = {
-            'C': 261.63, 'C#': 277.18, 'D': 293.66, 'D#': 311.13,
-            'E': 329.63, 'F': 349.23, 'F#': 369.99, 'G': 392.00,
-            'G#': 415.30, 'A': 440.00, 'A#': 466.16, 'B': 493.88
-        }
+        self.attack = attack
+        self.decay = decay
+        self.sustain_level = sustain_level
+        self.release = release
+        self.pulse_width = pulse_width
+        self.dtype = np.dtype(dtype)
+        
+        # LRU of envelope tables keyed by (num_samples, attack, decay, sustain_level, release, dtype)
+        self.envelope_cache_size = envelope_cache_size
+        self._envelope_cache = OrderedDict()
+
 
     def get_frequency(self, note_str):
         """
-        Parses a note string like 'C4', 'A#5', 'Gb3' into frequency.
+        Looks up a note string like 'C4', 'A#5', 'Gb3' or a MIDI number like '60'
+        in the precomputed equal-temperament table (A4 = 440Hz).
         Defaults to octave 4 if not specified.
         """
-        note_str = note_str.upper()
         if not note_str:
             return 0.0
             
-        # Handle simple flat/sharp conversion
-        if note_str[-1].isdigit():
-            octave = int(note_str[-1])
-            note = note_str[:-1]
-        else:
-            octave = 4
-            note = note_str
-            
-        base_freq = self.note_freqs.get(note)
-        if base_freq is None:
-            print(f"Warning: Note {note} not found, skipping.")
+        freq = NOTE_FREQUENCIES.get(note_str.upper())
+        if freq is None:
+            print(f"Warning: Note {note_str} not found, skipping.")
             return 0.0
-            
-        return base_freq * (2 ** (octave - 4))
+        return freq
+
+    def get_wavetables(self, wave_type):
+        if wave_type not in WAVE_TYPES:
+            wave_type = 'sine'
+        pulse_width = self.pulse_width if wave_type == 'pulse' else 0.5
+        return get_wavetables(wave_type, self.sample_rate, pulse_width, self.dtype)
+
+    def _band(self, frequencies):
+        """
+        Octave band (wavetable row) for each frequency.
+        """
+        bands = np.floor(np.log2(np.maximum(frequencies, LOWEST_FREQ) / LOWEST_FREQ))
+        return np.clip(bands, 0, _band_count(self.sample_rate) - 1).astype(np.intp)
+
+    def _oscillate(self, tables, cycles, rows):
+        """
+        Reads the wavetable bank at the given phase (in cycles) with linear interpolation.
+        The phase is wrapped in float64 (cycles is consumed in place); the interpolation
+        runs in the tables' dtype.
+        """
+        cycles -= np.floor(cycles)
+        cycles *= TABLE_SIZE
+        index = cycles.astype(np.intp)
+        cycles -= index
+        fraction = cycles.astype(tables.dtype, copy=False)
+        index += rows * (TABLE_SIZE + 1)
+        
+        flat = tables.ravel()
+        wave = flat[index]
+        wave += fraction * (flat[index + 1] - wave)
+        return wave
 
     def generate_wave(self, frequency, duration_sec, wave_type='sine'):
-        t = np.linspace(0, duration_sec, int(self.sample_rate * duration_sec), False)
-        
-        if wave_type == 'sine':
-            return np.sin(frequency * t * 2 * np.pi)
-        elif wave_type == 'square':
-            return signal.square(frequency * t * 2 * np.pi)
-        elif wave_type == 'sawtooth':
-            return signal.sawtooth(frequency * t * 2 * np.pi)
-        else:
-            return np.sin(frequency * t * 2 * np.pi)
+        num_samples = int(self.sample_rate * duration_sec)
+        increment = frequency * duration_sec / max(num_samples, 1)
+        cycles = np.arange(num_samples) * increment
+        return self._oscillate(self.get_wavetables(wave_type), cycles, self._band(frequency))
 
-    def apply_envelope(self, wave, duration_sec):
-        # Basic ADSR: 10% Attack, 10% Decay, 50% Sustain Level, 20% Release
-        total_samples = len(wave)
-        attack_len = int(0.1 * total_samples)
-        decay_len = int(0.1 * total_samples)
-        release_len = int(0.2 * total_samples)
-        sustain_len = total_samples - attack_len - decay_len - release_len
-        
-        sustain_level = 0.7
-        
-        attack = np.linspace(0, 1, attack_len)
-        decay = np.linspace(1, sustain_level, decay_len)
-        sustain = np.full(sustain_len, sustain_level)
-        release = np.linspace(sustain_level, 0, release_len)
-        
-        envelope = np.concatenate([attack, decay, sustain, release])
-        
-        # Handle potential length mismatch due to rounding
-        if len(envelope) < total_samples:
-            envelope = np.pad(envelope, (0, total_samples - len(envelope)), 'constant')
-        elif len(envelope) > total_samples:
-            envelope = envelope[:total_samples]
+    def get_envelope(self, num_samples):
+        """
+        Returns the ADSR envelope for a note of num_samples samples.
+        Melodies reuse a handful of durations, so tables are kept in a bounded LRU cache.
+        The returned array is shared and read-only.
+        """
+        key = (num_samples, self.attack, self.decay, self.sustain_level, self.release, self.dtype)
+        envelope = self._envelope_cache.get(key)
+        if envelope is not None:
+            self._envelope_cache.move_to_end(key)
+            return envelope
             
-        return wave * envelope
-
-    def generate_audio(self, note_sequence, bpm=120, wave_type='sine'):
-        audio_data = []
+        attack_len = int(self.attack * num_samples)
+        decay_len = int(self.decay * num_samples)
+        release_len = int(self.release * num_samples)
+        sustain_len = num_samples - attack_len - decay_len - release_len
         
-        notes = note_sequence.split()
+        envelope = np.concatenate([
+            np.linspace(0, 1, attack_len),
+            np.linspace(1, self.sustain_level, decay_len),
+            np.full(sustain_len, self.sustain_level),
+            np.linspace(self.sustain_level, 0, release_len),
+        ]).astype(self.dtype, copy=False)
+        envelope.flags.writeable = False
+        
+        self._envelope_cache[key] = envelope
+        if len(self._envelope_cache) > self.envelope_cache_size:
+            self._envelope_cache.popitem(last=False)
+        return envelope
+
+    def apply_envelope(self, wave, duration_sec):
+        return wave * self.get_envelope(len(wave))
+
+    def parse_sequence(self, note_sequence, bpm=120):
+        """
+        Parses a note string once into monophonic lanes.
+        Chord tokens spread their notes over parallel lanes of the same track, and every
+        track gets its own lanes starting at time 0.
+        Returns a list of (frequencies, durations in seconds, sample counts) per lane;
+        rests and missing chord voices have frequency 0.
+        """
+        lanes = []
         
         # 60 seconds / BPM = duration of one beat (quarter note)
         beat_duration = 60.0 / bpm
         
-        for token in notes:
-            # Parse token "Note:Duration" (e.g., "C4:1", "D#5:0.5")
-            if ':' in token:
-                note_str, duration_str = token.split(':')
-                try:
-                    duration_multiplier = float(duration_str)
-                except ValueError:
-                    duration_multiplier = 1.0
-            else:
-                note_str = token
-                duration_multiplier = 1.0 # Default to 1 beat
+        for tokens in split_tracks(note_sequence):
+            voices = []
+            durations = []
+            lengths = []
             
-            # Allow "R" or "REST" for silence
-            if note_str.upper() in ["R", "REST"]:
-                freq = 0.0
-            else:
-                freq = self.get_frequency(note_str)
+            for token in tokens:
+                # Parse token "Note:Duration" (e.g., "C4:1", "D#5:0.5", "C4+E4+G4:2")
+                if ':' in token:
+                    note_str, duration_str = token.split(':')
+                    try:
+                        duration_multiplier = float(duration_str)
+                    except ValueError:
+                        duration_multiplier = 1.0
+                else:
+                    note_str = token
+                    duration_multiplier = 1.0 # Default to 1 beat
+                
+                # Allow "R" or "REST" for silence
+                voices.append([
+                    0.0 if note.upper() in ["R", "REST"] else self.get_frequency(note)
+                    for note in note_str.split(CHORD_SEPARATOR)
+                ])
+                
+                duration_sec = beat_duration * duration_multiplier
+                num_samples = int(self.sample_rate * duration_sec)
+                if num_samples < 0:
+                    raise ValueError(f"Negative duration in token '{token}'")
+                
+                durations.append(duration_sec)
+                lengths.append(num_samples)
             
-            duration_sec = beat_duration * duration_multiplier
+            freqs = np.zeros((max(len(chord) for chord in voices), len(tokens)))
+            for i, chord in enumerate(voices):
+                freqs[:len(chord), i] = chord
+                
+            durations = np.array(durations, dtype=np.float64)
+            lengths = np.array(lengths, dtype=np.int64)
+            lanes.extend((lane_freqs, durations, lengths) for lane_freqs in freqs)
             
-            if freq > 0:
-                wave = self.generate_wave(freq, duration_sec, wave_type)
-                wave = self.apply_envelope(wave, duration_sec)
-                audio_data.append(wave)
-            else:
-                # Insert silence for rests
-                silence = np.zeros(int(self.sample_rate * duration_sec))
-                audio_data.append(silence)
+        return lanes
+
+    def _layout(self, freqs, durations, lengths):
+        """
+        Lays the parsed tokens out on one timeline with precomputed sample offsets.
+        Each token occupies its note (or rest) followed by a short gap.
+        """
+        # Every token is followed by a tiny bit of silence/spacing
+        gap = int(self.sample_rate * 0.01)
+        spans = lengths + gap
+        ends = np.cumsum(spans)
+        
+        return {
+            "total": int(ends[-1]) if len(ends) else 0,
+            "starts": ends - spans,
+            "ends": ends,
+            "lengths": lengths,
+            "freqs": freqs,
+            # Phase accumulator increment in cycles per sample
+            "increments": freqs * durations / np.maximum(lengths, 1),
+            "bands": self._band(freqs),
+        }
+
+    def _render_block(self, layout, lo, hi, out, wave_type):
+        """
+        Fills out[:hi - lo] with one lane's timeline samples [lo, hi).
+        Phase and wavetable reads cover the whole block at once; envelopes are copied
+        from cached tables. Returns False (and zero-fills) when the block is all rests.
+        """
+        first = np.searchsorted(layout["ends"], lo, side="right")
+        last = np.searchsorted(layout["starts"], hi, side="left")
+        tokens = slice(first, last)
+        
+        if not layout["freqs"][tokens].any():
+            out[:hi - lo] = 0
+            return False
+        
+        starts = layout["starts"][tokens]
+        counts = np.minimum(layout["ends"][tokens], hi) - np.maximum(starts, lo)
+        
+        cycles = np.arange(lo, hi) - np.repeat(starts, counts)
+        cycles = cycles * np.repeat(layout["increments"][tokens], counts)
+        wave = self._oscillate(self.get_wavetables(wave_type), cycles,
+                               np.repeat(layout["bands"][tokens], counts))
+        
+        # Rests and gaps keep a zero envelope
+        envelope = np.zeros(hi - lo, dtype=self.dtype)
+        for start, length, freq in zip(starts.tolist(), layout["lengths"][tokens].tolist(),
+                                       layout["freqs"][tokens].tolist()):
+            if freq <= 0:
+                continue
+            a = max(lo, start)
+            b = min(hi, start + length)
+            if a < b:
+                envelope[a - lo:b - lo] = self.get_envelope(length)[a - start:b - start]
+        
+        np.multiply(wave, envelope, out=out[:hi - lo])
+        return True
+
+    def _mix_block(self, layouts, lo, hi, out, wave_type):
+        """
+        Sums samples [lo, hi) of every lane into out[:hi - lo].
+        The first lane renders in place; the others are accumulated on top,
+        skipping lanes that are silent in this block.
+        """
+        out = out[:hi - lo]
+        lane_buffer = None
+        mixed = False
+        
+        for layout in layouts:
+            lane_hi = min(hi, layout["total"])
+            if lane_hi <= lo:
+                continue
+            if not mixed:
+                mixed = self._render_block(layout, lo, lane_hi, out, wave_type)
+                out[lane_hi - lo:] = 0
+                continue
+            if lane_buffer is None:
+                lane_buffer = np.empty(hi - lo, dtype=self.dtype)
+            if self._render_block(layout, lo, lane_hi, lane_buffer, wave_type):
+                out[:lane_hi - lo] += lane_buffer[:lane_hi - lo]
                 
-            # Add a tiny bit of silence/spacing (can be removed if we want legato)
-            # reduced to very small amount or zero if we trust envelope
-            gap = np.zeros(int(self.sample_rate * 0.01)) 
-            audio_data.append(gap)
+        if not mixed:
+            out[:] = 0
+
+    def _iter_blocks(self, layouts, wave_type, block_size):
+        """
+        Yields the mixed float signal in consecutive blocks of at most block_size samples.
+        The same buffer is reused for every block.
+        """
+        total = max(layout["total"] for layout in layouts)
+        buffer = np.empty(min(block_size, total), dtype=self.dtype)
+        for lo in range(0, total, block_size):
+            hi = min(lo + block_size, total)
+            block = buffer[:hi - lo]
+            self._mix_block(layouts, lo, hi, block, wave_type)
+            yield block
+
+    def stream_audio(self, note_sequence, bpm=120, wave_type='sine', block_size=None, peak='scan'):
+        """
+        Renders the sequence as a stream of int16 blocks, never holding the whole signal.
+        peak='scan' finds the exact peak in a first pass (same samples as generate_audio);
+        peak='bound' normalizes against the analytic bound of 1.0 per lane (unit-peak
+        wavetables under an envelope that never exceeds 1) and renders only once.
+        """
+        block_size = block_size or self.block_size
+        lanes = self.parse_sequence(note_sequence, bpm)
+        if not lanes:
+            return
             
-        if not audio_data:
-            return None
+        layouts = [self._layout(*lane) for lane in lanes]
+        
+        if peak == 'scan':
+            max_amplitude = 0.0
+            for block in self._iter_blocks(layouts, wave_type, block_size):
+                max_amplitude = max(max_amplitude, self._peak(block))
+        elif peak == 'bound':
+            max_amplitude = float(len(layouts))
+        else:
+            raise ValueError("peak must be 'scan' or 'bound'")
             
-        combined_signal = np.concatenate(audio_data)
+        for block in self._iter_blocks(layouts, wave_type, block_size):
+            yield self._quantize(block, max_amplitude, np.empty(len(block), dtype=np.int16))
+
+    def stream_tokens(self, tokens, bpm=120, wave_type='sine', voices=1):
+        """
+        Renders a single-track melody from an iterable of tokens that may still be arriving
+        (e.g. parsed from a streaming LLM reply), yielding int16 blocks as soon as each token
+        is known. Tokens render independently, so the output matches stream_audio with
+        peak='bound' over `voices` lanes; louder chords are clipped.
+        """
+        for token in tokens:
+            lanes = self.parse_sequence(token, bpm)
+            if not lanes:
+                continue
+            layouts = [self._layout(*lane) for lane in lanes]
+            for block in self._iter_blocks(layouts, wave_type, self.block_size):
+                np.clip(block, -voices, voices, out=block)
+                yield self._quantize(block, float(voices), np.empty(len(block), dtype=np.int16))
+
+    def normalize(self, samples):
+        """
+        Rescales int16 samples in place to full scale, e.g. the concatenated output of
+        stream_tokens, whose fixed bound leaves it slightly quieter than generate_audio.
+        """
+        peak = self._peak(samples)
+        if 0 < peak < 32767:
+            np.copyto(samples, samples * np.float32(32767 / peak), casting='unsafe')
+        return samples
+
+    @staticmethod
+    def _peak(signal):
+        # Same as np.max(np.abs(signal)) without the temporary
+        if len(signal) == 0:
+            return 0.0
+        return max(float(signal.max()), -float(signal.min()))
+
+    @staticmethod
+    def _quantize(signal, max_amplitude, out):
+        """
+        Normalizes signal in place to the 16-bit range and truncates it into the int16 array out.
+        """
+        if max_amplitude > 0:
+            signal *= 32767 / max_amplitude
+        np.copyto(out, signal, casting='unsafe')
+        return out
+
+    def generate_audio(self, note_sequence, bpm=120, wave_type='sine', out=None):
+        """
+        Renders the whole sequence to int16 samples.
+        out may be a caller-owned int16 array at least as long as the render; the result
+        is written into it and the filled prefix is returned.
+        """
+        lanes = self.parse_sequence(note_sequence, bpm)
+        
+        if not lanes:
+            return None
+        
+        layouts = [self._layout(*lane) for lane in lanes]
+        total = max(layout["total"] for layout in layouts)
+        
+        if out is None:
+            out = np.empty(total, dtype=np.int16)
+        elif out.dtype != np.int16 or len(out) < total:
+            raise ValueError(f"out must be an int16 array of at least {total} samples")
+        out = out[:total]
+        
+        # Float mix for this render only; an instance that kept it would pin the largest
+        # render's worth of memory for as long as the session lives
+        combined_signal = np.empty(total, dtype=self.dtype)
+        for lo in range(0, total, self.block_size):
+            hi = min(lo + self.block_size, total)
+            self._mix_block(layouts, lo, hi, combined_signal[lo:hi], wave_type)
         
         # Normalize to 16-bit range
-        if np.max(np.abs(combined_signal)) > 0:
-             combined_signal *= 32767 / np.max(np.abs(combined_signal))
-             
-        return combined_signal.astype(np.int16)
-
-    def save_wav(self, filename, data):
-        write(filename, self.sample_rate, data)
-        print(f"Saved to {filename}")
+        return self._quantize(combined_signal, self._peak(combined_signal), out)
+
+    def save_wav(self, filename, data, verbose=True):
+        """
+        Writes int16 audio to a WAV file. data may be a full array or an iterable of blocks
+        (e.g. from stream_audio).
+        """
+        with WavWriter(filename, self.sample_rate) as writer:
+            if isinstance(data, np.ndarray):
+                writer.write(data)
+            else:
+                for block in data:
+                    writer.write(block)
+        if verbose:
+            print(f"Saved to {filename}")
+        return writer.frames
+
+    def render_to_wav(self, filename, note_sequence, bpm=120, wave_type='sine', peak='scan', verbose=True):
+        """
+        Streams a render straight to disk with constant memory.
+        Returns the number of samples written, or 0 (and writes nothing) if no notes were found.
+        """
+        blocks = self.stream_audio(note_sequence, bpm, wave_type, peak=peak)
+        first = next(blocks, None)
+        if first is None:
+            return 0
+        return self.save_wav(filename, chain([first], blocks), verbose=verbose)
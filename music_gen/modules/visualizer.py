@@ -1,40 +1,108 @@
-
 import matplotlib.pyplot as plt
 import numpy as np
 
-def plot_waveform(audio_data, sample_rate):
+# Colors shared by the raster renderer and the matplotlib figure
+BACKGROUND = (0x0E, 0x11, 0x17)
+WAVE_COLOR = (0x00, 0xD4, 0xFF)
+GRID_COLOR = (0x26, 0x2B, 0x36)
+WAVE_ALPHA = 0.8
+
+def peak_columns(audio_data, width):
+    """
+    Reduces the signal to `width` (min, max) pairs, one per pixel column, in a single
+    vectorized pass. Returns fewer columns when there are fewer samples than pixels.
+    """
+    n = len(audio_data)
+    width = max(1, min(width, n))
+    edges = (np.arange(width, dtype=np.int64) * n) // width
+    return np.minimum.reduceat(audio_data, edges), np.maximum.reduceat(audio_data, edges)
+
+def render_waveform(audio_data, sample_rate, width=1000, height=300):
+    """
+    Rasterizes the waveform straight into an RGB uint8 image of shape (height, width, 3):
+    one min/max bar per pixel column over a center line and a grid line per second.
+    Cost is O(samples + pixels), independent of how many vertices a line plot would need.
+    """
+    lows, highs = peak_columns(audio_data, width) if len(audio_data) else (None, None)
+    return render_columns(lows, highs, len(audio_data) / sample_rate, width, height)
+
+def render_peaks(peaks, width=1000, height=300):
+    """
+    Same image as render_waveform, drawn from a peaks sidecar in O(pixels).
+    """
+    lows, highs = peaks.columns(width)
+    return render_columns(lows if len(lows) else None, highs, peaks.duration, width, height)
+
+def render_columns(lows, highs, duration, width=1000, height=300):
+    """
+    Draws per-column (min, max) pairs spanning `duration` seconds into an RGB image.
+    """
+    image = np.empty((height, width, 3), dtype=np.uint8)
+    image[:] = BACKGROUND
+    if lows is None or duration <= 0:
+        return image
+
+    seconds = np.arange(1, int(duration) + 1)
+    image[:, (seconds * width / duration).astype(np.int64).clip(0, width - 1)] = GRID_COLOR
+    image[height // 2, :] = GRID_COLOR
+
+    if len(lows) < width:
+        # Short signals: stretch the columns over the full width
+        columns = np.arange(width) * len(lows) // width
+        lows, highs = lows[columns], highs[columns]
+
+    # 5% headroom above the loudest sample, like matplotlib's default margins
+    scale = max(float(highs.max()), -float(lows.min()), 1e-12) / 0.95
+    half = (height - 1) / 2
+    top = np.round(half - highs / scale * half).astype(np.int64)
+    bottom = np.round(half - lows / scale * half).astype(np.int64)
+
+    rows = np.arange(height)[:, None]
+    bars = (rows >= top) & (rows <= bottom)
+    color = np.round(np.multiply(WAVE_ALPHA, WAVE_COLOR) + np.multiply(1 - WAVE_ALPHA, BACKGROUND))
+    image[bars] = color.astype(np.uint8)
+    return image
+
+def save_png(image, path):
+    """
+    Writes an image array from render_waveform to a PNG file.
+    """
+    plt.imsave(path, image)
+
+def plot_waveform(audio_data, sample_rate, width=2000):
     """
     Generates a matplotlib figure of the waveform.
+    The signal is decimated to per-column min/max envelopes first, so the figure holds a
+    few thousand vertices however long the audio is.
     """
-    # Create time axis
-    time = np.linspace(0, len(audio_data) / sample_rate, num=len(audio_data))
-    
+    lows, highs = peak_columns(audio_data, width)
+    time = np.arange(len(lows)) * (len(audio_data) / max(len(lows), 1) / sample_rate)
+
     # Setup dark theme plot
     fig, ax = plt.subplots(figsize=(10, 4))
-    
+
     # Plot data
-    # Downsample for performance if needed, but for short clips it's fine
-    ax.plot(time, audio_data, color='#00d4ff', alpha=0.8, linewidth=0.5)
-    
+    ax.fill_between(time, lows, highs, color='#00d4ff', alpha=0.8, linewidth=0.5)
+
     # Styling
     ax.set_title("Audio Waveform")
     ax.set_xlabel("Time (s)")
     ax.set_ylabel("Amplitude")
-    
+
     # Dark background styling
     ax.set_facecolor('#0E1117')
     fig.patch.set_facecolor('#0E1117')
-    
+
     ax.spines['bottom'].set_color('white')
-    ax.spines['left'].set_color('white') 
+    ax.spines['left'].set_color('white')
     ax.spines['top'].set_visible(False)
     ax.spines['right'].set_visible(False)
-    
+
     ax.tick_params(axis='x', colors='#FAFAFA')
     ax.tick_params(axis='y', colors='#FAFAFA')
     ax.yaxis.label.set_color('#FAFAFA')
     ax.xaxis.label.set_color('#FAFAFA')
     ax.title.set_color('#FAFAFA')
-    
+
     plt.tight_layout()
     return fig
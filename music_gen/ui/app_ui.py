@@ -2,15 +2,35 @@
 import streamlit as st
 import os
 import uuid
+import io
+import numpy as np
 from datetime import datetime
-from modules.db import get_db, Generation, User
+from modules.db import session_scope, Generation, User
+from modules.history import history_cache, mark_files_deleted
 # Use absolute imports assuming music_gen is in path
-from modules.synthesizer import Synthesizer
+from modules.synthesizer import Synthesizer, WavWriter, WAVE_TYPES, SHARP_NAMES
 from modules.composer import MarkovComposer
+from modules.render_cache import render_cache
+from modules.jobs import job_queue, FAILED
 from modules import visualizer
+from modules.peaks import Peaks, write_peaks
 
 # from modules import session_manager
 
+CORPUS_PATH = "music_gen/data/songs.txt"
+MODEL_DIR = "music_gen/data/markov_model"
+MAJOR_SCALE = (0, 2, 4, 5, 7, 9, 11)
+HISTORY_WAVEFORM_WIDTH = 600
+
+@st.cache_resource
+def load_composer(corpus_mtime):
+    """
+    One read-only, memory-mapped Markov model per process, shared by every session.
+    The artifact is only retrained when the corpus content changes; corpus_mtime just
+    busts this cache so the hash gets re-checked after edits.
+    """
+    return MarkovComposer.load_or_train(CORPUS_PATH, MODEL_DIR)
+
 def render_sidebar(user):
     with st.sidebar:
         # User Profile
@@ -42,7 +62,7 @@ def render_sidebar(user):
         
         st.markdown("### 🎛️ Audio Engine")
         bpm = st.slider("Tempo", 60, 240, 120, help="Beats Per Minute")
-        wave_type = st.selectbox("Oscillator", ["sine", "square", "sawtooth"], format_func=lambda x: x.capitalize())
+        wave_type = st.selectbox("Oscillator", WAVE_TYPES, format_func=lambda x: x.capitalize())
         
         st.markdown("### 🧠 AI Model")
         ai_length = st.number_input("Sequence Length", min_value=4, max_value=128, value=16, step=4)
@@ -59,16 +79,8 @@ def render_main_app(user):
     if 'synth' not in st.session_state:
         st.session_state.synth = Synthesizer()
 
-    if 'composer' not in st.session_state:
-        st.session_state.composer = MarkovComposer()
-        # Load training data
-        training_data = []
-        if os.path.exists("music_gen/data/songs.txt"):
-            with open("music_gen/data/songs.txt", "r") as f:
-                training_data.extend([line.strip() for line in f if line.strip()])
-        # Defaults
-        training_data.extend(st.session_state.composer.load_data())
-        st.session_state.composer.train(training_data)
+    corpus_mtime = os.path.getmtime(CORPUS_PATH) if os.path.exists(CORPUS_PATH) else 0
+    st.session_state.composer = load_composer(corpus_mtime)
 
     st.title("🎹 AI Music Composer")
     st.markdown("### Create music from text or let AI invent a melody.")
@@ -82,27 +94,45 @@ def render_main_app(user):
         tab_manual, tab_ai, tab_agent = st.tabs(["Manual Input", "Markov Chain", "Agentic AI"])
         
         generated_audio = None
+        render_key = None
         prompt_used = ""
         
         with tab_manual:
             user_input = st.text_area("Melody String", value="C4:1 E4:1 G4:1 C5:2", height=100)
-            st.caption("Format: `Note:Duration` (e.g. `C4:1`)")
+            st.caption("Format: `Note:Duration` (e.g. `C4:1`), chords `C4+E4+G4:1`, parallel tracks separated by `|`")
             if st.button("Generate Audio", key="btn_manual"):
                 with st.spinner("Synthesizing..."):
-                    generated_audio = st.session_state.synth.generate_audio(user_input, bpm=bpm, wave_type=wave_type)
+                    generated_audio, render_key = render_cache.render(st.session_state.synth, user_input, bpm=bpm, wave_type=wave_type)
                     prompt_used = "Manual Input"
         
         with tab_ai:
-            st.info(f"Learned Transitions: **{len(st.session_state.composer.chain)}**")
+            st.info(f"Learned Transitions: **{st.session_state.composer.num_transitions}**")
+            with st.expander("Constraints"):
+                key_name = st.selectbox("Major key", ["Any"] + SHARP_NAMES)
+                octaves = st.slider("Octave range", 0, 9, (0, 9))
+                end_on_tonic = st.checkbox("End on the tonic", value=False, disabled=key_name == "Any")
+            constrained = key_name != "Any" or octaves != (0, 9)
             if st.button("✨ Compose & Generate", key="btn_ai"):
                 with st.spinner("Composing..."):
-                    generated_notes = st.session_state.composer.compose(length=ai_length)
-                    st.success(f"**Composed:** `{generated_notes}`")
-                    generated_audio = st.session_state.synth.generate_audio(generated_notes, bpm=bpm, wave_type=wave_type)
-                    prompt_used = "Markov Chain Composition"
+                    if constrained:
+                        scale = None
+                        if key_name != "Any":
+                            tonic = SHARP_NAMES.index(key_name)
+                            scale = [SHARP_NAMES[(tonic + step) % 12] for step in MAJOR_SCALE]
+                        generated_notes = st.session_state.composer.compose_constrained(
+                            length=ai_length, allowed_pitches=scale, octave_range=octaves,
+                            end_note=key_name if scale and end_on_tonic else None)
+                    else:
+                        generated_notes = st.session_state.composer.compose(length=ai_length)
+                    if generated_notes:
+                        st.success(f"**Composed:** `{generated_notes}`")
+                        generated_audio, render_key = render_cache.render(st.session_state.synth, generated_notes, bpm=bpm, wave_type=wave_type)
+                        prompt_used = "Markov Chain Composition"
+                    else:
+                        st.warning("The learned melodies cannot satisfy these constraints.")
                     
         with tab_agent:
-            from modules.agent import get_available_models, MusicAgent
+            from modules.agent import get_available_models, get_agent
             
             @st.cache_data(ttl=3600)
             def fetch_models(key, only_free):
@@ -112,6 +142,7 @@ def render_main_app(user):
             models = fetch_models(api_key, only_free)
             selected_model = st.selectbox("Model", models)
             agent_prompt = st.text_input("Prompt", placeholder="A sad melody in D minor...")
+            stream_audio = st.checkbox("Synthesize while the agent writes", value=True)
             
             if st.button("🚀 Agent Generate", key="btn_agent"):
                 if not api_key:
@@ -119,11 +150,27 @@ def render_main_app(user):
                 else:
                     try:
                         with st.spinner(f"Agent ({selected_model}) is thinking..."):
-                            agent = MusicAgent(api_key=api_key, model_name=selected_model)
-                            result = agent.run(agent_prompt)
+                            agent = get_agent(api_key, selected_model)
+                            if stream_audio:
+                                # Synthesize each note while the LLM is still writing the rest
+                                stream = agent.stream_notes(agent_prompt)
+                                live = st.empty()
+                                def progress():
+                                    for token in stream:
+                                        live.code(" ".join(stream.tokens))
+                                        yield token
+                                blocks = list(st.session_state.synth.stream_tokens(progress(), bpm=bpm, wave_type=wave_type))
+                                live.empty()
+                                result = stream.result()
+                            else:
+                                result = agent.run(agent_prompt)
                             if result['is_valid']:
                                 st.success(f"**Generated:** `{result['notes']}`")
-                                generated_audio = st.session_state.synth.generate_audio(result['notes'], bpm=bpm, wave_type=wave_type)
+                                if stream_audio and blocks and stream.matches(result):
+                                    generated_audio = st.session_state.synth.normalize(np.concatenate(blocks))
+                                    render_key = None
+                                else:
+                                    generated_audio, render_key = render_cache.render(st.session_state.synth, result['notes'], bpm=bpm, wave_type=wave_type)
                                 prompt_used = f"Agent: {agent_prompt}"
                             else:
                                 st.error(result.get('error'))
@@ -132,93 +179,138 @@ def render_main_app(user):
         st.markdown('</div>', unsafe_allow_html=True)
 
         # Save and Output
+        waveform = None
         if generated_audio is not None:
-             handle_output(generated_audio, user, prompt_used)
+             waveform = handle_output(generated_audio, user, prompt_used, render_key)
 
     with col2:
-        render_visualization_and_history(generated_audio, user)
+        render_visualization_and_history(waveform, user)
 
-def handle_output(audio, user, prompt):
+def save_generation(user, audio, sample_rate, render_key, prompt, waveform, output_dir, names):
+    """
+    Writes the WAV, PNG and peaks files, then records the generation. Runs on the job
+    queue so the page never waits for disk or the database.
+    """
+    filename, img_filename, peaks_filename = names
+    os.makedirs(output_dir, exist_ok=True)
+    
+    # Save Audio (hard-linked to the shared render cache blob when available; the
+    # cleanup job ages it by this generation's created_at, not the shared inode's ctime)
+    render_cache.save_to(render_key, os.path.join(output_dir, filename), audio, sample_rate)
+    visualizer.save_png(waveform, os.path.join(output_dir, img_filename))
+    write_peaks(os.path.join(output_dir, peaks_filename), audio, sample_rate)
+    
+    # DB Save last, so a listed generation always has its files
+    with session_scope() as db:
+        new_gen = Generation(user_id=user['id'], filename=filename, image_filename=img_filename,
+                             peaks_filename=peaks_filename, prompt=prompt)
+        db.add(new_gen)
+    history_cache.invalidate(user['id'])
+    return new_gen.id
+
+def handle_output(audio, user, prompt, render_key):
     st.markdown('<div class="glass-card">', unsafe_allow_html=True)
     st.markdown('<div class="section-header">🔊 Playback Studio</div>', unsafe_allow_html=True)
     
+    sample_rate = st.session_state.synth.sample_rate
+    
     # User specific dir
     OUTPUT_DIR = os.path.join("music_gen/generated", user['username'])
-    os.makedirs(OUTPUT_DIR, exist_ok=True)
     
     # Unique Filename
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     unique_id = str(uuid.uuid4())[:8]
     filename = f"melody_{timestamp}_{unique_id}.wav"
     img_filename = f"viz_{timestamp}_{unique_id}.png"
+    peaks_filename = f"peaks_{timestamp}_{unique_id}.peaks"
     
-    path = os.path.join(OUTPUT_DIR, filename)
-    img_path = os.path.join(OUTPUT_DIR, img_filename)
+    # The waveform is drawn once: shown on screen now, saved as the PNG in the background
+    waveform = visualizer.render_waveform(audio, sample_rate)
+    job_id = job_queue.submit(save_generation, dict(user), audio, sample_rate, render_key, prompt,
+                              waveform, OUTPUT_DIR, (filename, img_filename, peaks_filename))
+    st.session_state.setdefault("save_jobs", []).append(job_id)
+    st.session_state.history_cursors = [None] # back to the newest page
     
-    # Save Audio
-    st.session_state.synth.save_wav(path, audio)
-    
-    # Save Visualization
-    if 'synth' in st.session_state:
-         fig = visualizer.plot_waveform(audio, st.session_state.synth.sample_rate)
-         fig.savefig(img_path, facecolor='#0E1117', bbox_inches='tight', pad_inches=0.1)
-         # Clean up memory
-         import matplotlib.pyplot as plt
-         plt.close(fig)
-    
-    # DB Save
-    db = next(get_db())
-    new_gen = Generation(user_id=user['id'], filename=filename, image_filename=img_filename, prompt=prompt)
-    db.add(new_gen)
-    db.commit()
+    # Playback and download come straight from memory, not from the file being written
+    wav_bytes = io.BytesIO()
+    with WavWriter(wav_bytes, sample_rate) as writer:
+        writer.write(audio)
     
     col_play, col_dl = st.columns([3, 1])
     with col_play:
-        st.audio(path)
+        st.audio(wav_bytes.getvalue(), format="audio/wav")
     with col_dl:
-        with open(path, "rb") as f:
-            st.download_button("Download", f, filename, "audio/wav", width="stretch")
+        st.download_button("Download", wav_bytes.getvalue(), filename, "audio/wav", width="stretch")
             
     st.markdown('</div>', unsafe_allow_html=True)
+    return waveform
+
+@st.fragment(run_every=1)
+def render_save_status():
+    """
+    Polls this session's save jobs; once they are all finished, reruns the page so the
+    new generations appear in the history.
+    """
+    jobs = st.session_state.get("save_jobs", [])
+    pending = job_queue.pending(jobs)
+    if pending:
+        st.caption(f"💾 Saving {len(pending)} generation(s)...")
+        return
+    failed = [job_queue.status(job_id) for job_id in jobs]
+    st.session_state.save_errors = [job["error"] for job in failed if job and job["status"] == FAILED]
+    st.session_state.save_jobs = []
+    st.rerun()
 
-def render_visualization_and_history(audio, user):
+def render_visualization_and_history(waveform, user):
     st.markdown('<div class="glass-card">', unsafe_allow_html=True)
     st.markdown('<div class="section-header">📉 Visualization</div>', unsafe_allow_html=True)
     
-    if audio is not None:
-        if 'synth' in st.session_state:
-             fig = visualizer.plot_waveform(audio, st.session_state.synth.sample_rate)
-             st.pyplot(fig, width="stretch")
+    if waveform is not None:
+        st.image(waveform, width="stretch")
     else:
         st.info("Generate audio to see waveform")
     st.markdown('</div>', unsafe_allow_html=True)
         
+    if st.session_state.get("save_jobs"):
+        render_save_status()
+    for error in st.session_state.pop("save_errors", []):
+        st.error(f"Could not save a generation: {error}")
+        
     # Removed duplicate header
-    db = next(get_db())
-    history = db.query(Generation).filter(Generation.user_id == user['id']).order_by(Generation.created_at.desc()).limit(10).all()
+    # Cached per user until a save job adds a row or the cleanup job removes files.
+    # history_cursors is the stack of keyset cursors of the pages scrolled through.
+    cursors = st.session_state.setdefault("history_cursors", [None])
+    history, next_cursor = history_cache.page(user['id'], before=cursors[-1])
     
-    if not history:
+    if not history and len(cursors) == 1:
         st.info("No music generated yet. Create something!")
         
     for item in history:
         user_dir = os.path.join("music_gen/generated", user['username'])
-        h_path = os.path.join(user_dir, item.filename)
-        file_exists = os.path.exists(h_path)
+        h_path = os.path.join(user_dir, item["filename"])
+        file_exists = item["available"]
+        
+        audio_bytes = None
+        if file_exists:
+            try:
+                with open(h_path, "rb") as f:
+                    audio_bytes = f.read()
+            except FileNotFoundError:
+                # Deleted before the cleanup job recorded deletions; record it now
+                mark_files_deleted([item["filename"]])
+                file_exists = False
         
-        # Check for visualization image
-        img_path = None
-        if item.image_filename:
-            possible_path = os.path.join(user_dir, item.image_filename)
-            if os.path.exists(possible_path):
-                img_path = possible_path
+        # Visualization: peaks sidecar first, saved image for older generations
+        peaks_path = os.path.join(user_dir, item["peaks_filename"]) if file_exists and item["peaks_filename"] else None
+        img_path = os.path.join(user_dir, item["image_filename"]) if file_exists and item["image_filename"] else None
             
         with st.container():
             st.markdown(f"""
             <div class="history-card">
                 <div style="display: flex; justify-content: space-between; align-items: start;">
                     <div style="width: 100%;">
-                        <span style="font-weight: 600; color: #E2E8F0; font-size: 1rem;">🎵 {item.prompt[:40] or 'Melody'}...</span>
-                        <div style="font-size: 0.8rem; color: #94A3B8; margin-top: 4px;">Created at {item.created_at.strftime('%H:%M • %d %b')}</div>
+                        <span style="font-weight: 600; color: #E2E8F0; font-size: 1rem;">🎵 {item["prompt"][:40] or 'Melody'}...</span>
+                        <div style="font-size: 0.8rem; color: #94A3B8; margin-top: 4px;">Created at {item["created_at"].strftime('%H:%M • %d %b')}</div>
                     </div>
                 </div>
             </div>
@@ -228,22 +320,33 @@ def render_visualization_and_history(audio, user):
             # Let's put image inside an expander to keep it clean, or just show it small.
             # User asked to "save the visualization", presumably to see it.
             
-            if img_path:
+            if peaks_path or img_path:
                 with st.expander("See Waveform"):
-                    st.image(img_path, width="stretch")
+                    if peaks_path:
+                        st.image(visualizer.render_peaks(Peaks.read(peaks_path), width=HISTORY_WAVEFORM_WIDTH), width="stretch")
+                    else:
+                        st.image(img_path, width="stretch")
             
             # Action Row
             col_audio, col_actions = st.columns([3, 1])
             
             with col_audio:
                 if file_exists:
-                    st.audio(h_path)
+                    st.audio(audio_bytes, format="audio/wav")
                 else:
                     st.error("File not found")
             
             with col_actions:
                 if file_exists:
-                    with open(h_path, "rb") as f:
-                        st.download_button("⬇️", f, item.filename, "audio/wav", key=f"dl_{item.id}", help="Download WAV")
+                    st.download_button("⬇️", audio_bytes, item["filename"], "audio/wav", key=f"dl_{item['id']}", help="Download WAV")
             
             st.markdown("---")
+    
+    if len(cursors) > 1 or next_cursor is not None:
+        col_newer, col_older = st.columns(2)
+        with col_newer:
+            st.button("← Newer", key="history_newer", on_click=cursors.pop,
+                      disabled=len(cursors) == 1, width="stretch")
+        with col_older:
+            st.button("Older →", key="history_older", on_click=cursors.append, args=(next_cursor,),
+                      disabled=next_cursor is None, width="stretch")
@@ -1,7 +1,7 @@
 
 import streamlit as st
 # import extra_streamlit_components as stx # Removed
-from modules.db import get_db
+from modules.db import session_scope
 from modules.auth import create_user, authenticate_user
 # from modules.auth_token import create_access_token # Removed
 from sqlalchemy.exc import IntegrityError
@@ -43,8 +43,8 @@ def render_login_ui():
                         if not username or not password:
                             st.error("Please enter both username and password")
                         else:
-                            db = next(get_db())
-                            user = authenticate_user(db, username, password)
+                            with session_scope() as db:
+                                user = authenticate_user(db, username, password)
                             if user:
                                 st.session_state.user = {'id': user.id, 'username': user.username}
                                 st.success(f"Welcome back, {user.username}!")
@@ -66,9 +66,9 @@ def render_login_ui():
                         elif new_pass != confirm_pass:
                             st.error("Passwords do not match")
                         else:
-                            db = next(get_db())
                             try:
-                                user = create_user(db, new_user, new_pass)
+                                with session_scope() as db:
+                                    user = create_user(db, new_user, new_pass)
                                 st.session_state.user = {'id': user.id, 'username': user.username}
                                 st.success("Account created! Logging in...")
                                 st.rerun()
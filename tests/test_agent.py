@@ -0,0 +1,129 @@
+import asyncio
+import threading
+import time
+
+import pytest
+from langchain_core.messages import AIMessage
+
+from music_gen.modules.agent import MusicAgent, repair_notes
+from music_gen.modules.llm_cache import LLMCache
+
+class StubLLM:
+    """
+    Chat model stand-in that answers with the given replies in turn (an exception reply
+    is raised), after an optional delay in seconds.
+    """
+    temperature = 0.7
+
+    def __init__(self, replies, delay=0):
+        self.replies = list(replies)
+        self.delay = delay
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def _next(self):
+        with self._lock:
+            self.calls += 1
+            reply = self.replies.pop(0)
+        if isinstance(reply, Exception):
+            raise reply
+        return AIMessage(content=reply)
+
+    def invoke(self, messages):
+        time.sleep(self.delay)
+        return self._next()
+
+    async def ainvoke(self, messages):
+        await asyncio.sleep(self.delay)
+        return self._next()
+
+    def stream(self, messages):
+        # The reply in small chunks that split tokens
+        content = self.invoke(messages).content
+        for start in range(0, len(content), 3):
+            yield AIMessage(content=content[start:start + 3])
+
+@pytest.fixture
+def cache(tmp_path):
+    return LLMCache(str(tmp_path / "llm_cache.db"))
+
+def cached_replies(cache):
+    with cache._lock:
+        return [row[0] for row in cache._connection().execute("SELECT content FROM responses")]
+
+def test_only_the_validated_reply_is_cached(cache):
+    llm = StubLLM(["not a melody", "still not a melody", "C4:1 E4:1 G4:2"])
+    result = MusicAgent("key", "stub", llm=llm, cache=cache).run("sunrise")
+    assert result["is_valid"]
+    assert result["notes"] == "C4:1 E4:1 G4:2"
+    assert result["retries"] == 3
+    assert cached_replies(cache) == ["C4:1 E4:1 G4:2"]
+
+def test_invalid_first_reply_is_asked_again(cache):
+    # The first attempt's bad reply was not cached, so the same topic calls the model again
+    MusicAgent("key", "stub", llm=StubLLM(["not a melody", "C4:1 E4:1"]), cache=cache).run("rain")
+    llm = StubLLM(["D4:1 F4:1"])
+    result = MusicAgent("key", "stub", llm=llm, cache=cache).run("rain")
+    assert llm.calls == 1
+    assert result["notes"] == "D4:1 F4:1"
+
+def test_valid_first_reply_is_served_from_cache(cache):
+    MusicAgent("key", "stub", llm=StubLLM(["C4:1 E4:1"]), cache=cache).run("snow")
+    llm = StubLLM([])
+    result = MusicAgent("key", "stub", llm=llm, cache=cache).run("snow")
+    assert llm.calls == 0
+    assert result["notes"] == "C4:1 E4:1"
+
+def test_arun_batch_coalesces_identical_topics(cache):
+    llm = StubLLM(["C4:1 E4:1 G4:2"], delay=0.2)
+    results = MusicAgent("key", "stub", llm=llm, cache=cache).run_batch(["dawn"] * 4)
+    assert llm.calls == 1
+    assert [result["notes"] for result in results] == ["C4:1 E4:1 G4:2"] * 4
+    assert cached_replies(cache) == ["C4:1 E4:1 G4:2"]
+
+def test_arun_batch_times_out_slow_topics(cache):
+    llm = StubLLM(["C4:1 E4:1"] * 2, delay=30)
+    agent = MusicAgent("key", "stub", llm=llm, cache=cache)
+    start = time.perf_counter()
+    results = agent.run_batch(["dusk", "night"], timeout=0.2)
+    assert time.perf_counter() - start < 5
+    for topic, result in zip(["dusk", "night"], results):
+        assert result["topic"] == topic
+        assert not result["is_valid"]
+        assert result["error"] == "Timed out after 0.2s"
+    assert cached_replies(cache) == []
+
+def test_arun_batch_reports_failures_per_topic(cache):
+    # Distinct topics, so each gets its own model call; the failure stays with its topic
+    llm = StubLLM([RuntimeError("model down"), "C4:1 E4:1"])
+    results = MusicAgent("key", "stub", llm=llm, cache=cache).run_batch(["storm", "calm"], max_concurrency=1)
+    assert results[0]["error"] == "RuntimeError: model down"
+    assert not results[0]["is_valid"]
+    assert results[1]["is_valid"]
+    assert results[1]["notes"] == "C4:1 E4:1"
+
+def test_repair_keeps_wrapped_lines_in_one_track():
+    notes, quality = repair_notes("Here is your melody:\nC4:1 D4:1 E4\nF4:1 Bb3:1/2")
+    assert notes == "C4:1 D4:1 E4:1 F4:1 A#3:0.5"
+    assert quality == 1.0
+
+def test_repair_continues_each_track_across_lines():
+    notes, _ = repair_notes("C4:1 D4:1 | C3:2\nE4:1 F4:1 | G3:2")
+    assert notes == "C4:1 D4:1 E4:1 F4:1 | C3:2 G3:2"
+
+def test_streamed_melody_matches_final_notes(cache):
+    agent = MusicAgent("key", "stub", llm=StubLLM(["C4:1 D4:0.5 E4:2"]), cache=cache)
+    stream = agent.stream_notes("breeze")
+    assert list(stream) == ["C4:1", "D4:0.5", "E4:2"]
+    state = stream.result()
+    assert stream.matches(state)
+    assert cached_replies(cache) == ["C4:1 D4:0.5 E4:2"]
+
+@pytest.mark.parametrize("reply", ["C4:1 D4:1 C4+E4+G4:1 E4:1", "C4:1 D4:1 | C3:2"])
+def test_stream_holds_back_chords_and_tracks(cache, reply):
+    agent = MusicAgent("key", "stub", llm=StubLLM([reply]), cache=cache)
+    stream = agent.stream_notes("thunder")
+    assert list(stream) == ["C4:1", "D4:1"]
+    state = stream.result()
+    assert state["is_valid"]
+    assert not stream.matches(state)
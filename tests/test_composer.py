@@ -0,0 +1,187 @@
+import itertools
+import random
+from collections import Counter
+
+import numpy as np
+import pytest
+
+from music_gen.modules.composer import MarkovComposer, TransitionTable
+
+CORPUS = [
+    "C4:1 D4:1 E4:1 C4:1 G4:0.5 E4:1 D4:1 C4:1 E4:1",
+    "E4:1 G4:0.5 C4:1 D4:1 G4:0.5 D4:1 E4:1 A4:2 G4:0.5 C4:1",
+    "A4:2 E4:1 C4:1 G4:0.5 A4:2 D4:1",
+]
+
+# Adds new tokens, and F4:3 is a dead end
+EXTRA = [
+    "F4:1 C4:1 B4:0.5 D4:1 E4:1 F4:1 G4:0.5",
+    "C4:1 D4:1 E4:1 F4:1 G4:0.5 A4:2 B4:0.5 C4:1 F4:3",
+]
+
+def count_table_compose(melodies, length):
+    """
+    Order-1 sampling as the count-table composer did it, using the random module:
+    a uniform random state, then per step a binary search of random.random() in the
+    row's cumulative probabilities (successors in id order), restarting at dead ends.
+    """
+    index = {}
+    counts = {}
+    for melody in melodies:
+        ids = [index.setdefault(token, len(index)) for token in melody.split()]
+        for a, b in zip(ids, ids[1:]):
+            row = counts.setdefault(a, Counter())
+            row[b] += 1
+    vocab = list(index)
+    states = sorted(counts)
+
+    history = [int(random.choice(states))]
+    for _ in range(length - 1):
+        row = counts.get(history[-1])
+        if not row:
+            history.append(int(random.choice(states)))
+            continue
+        successors = sorted(row)
+        running = np.cumsum([row[s] for s in successors])
+        offset = np.searchsorted(running / running[-1], random.random(), side="right")
+        history.append(successors[min(offset, len(successors) - 1)])
+    return " ".join(vocab[token_id] for token_id in history)
+
+def conditional_distribution(composer, length, accept):
+    """
+    Exact distribution of order-1 compose() melodies of this length given accept(tokens):
+    what rejection sampling converges to. compose() starts from a uniformly chosen state.
+    """
+    chain = composer.chains["token"]
+    matrix = chain.transition_matrix()
+    states = [int(state) for state in chain.states]
+    probabilities = {}
+    for ids in itertools.product(states, *[range(len(chain.vocab))] * (length - 1)):
+        probability = 1.0 / len(states)
+        for a, b in zip(ids, ids[1:]):
+            probability *= matrix[a, b]
+        tokens = [chain.vocab[token_id] for token_id in ids]
+        if probability > 0 and accept(tokens):
+            probabilities[" ".join(tokens)] = probability
+    total = sum(probabilities.values())
+    return {melody: probability / total for melody, probability in probabilities.items()}
+
+def total_variation(samples, distribution):
+    counts = Counter(samples)
+    melodies = set(counts) | set(distribution)
+    return 0.5 * sum(abs(counts[m] / len(samples) - distribution.get(m, 0)) for m in melodies)
+
+def table_arrays(composer):
+    return [np.array(getattr(table, name)) for chain in composer.chains.values()
+            for table in chain.tables for name in TransitionTable.ARRAYS]
+
+def test_order1_sampling_matches_count_table_composer():
+    composer = MarkovComposer(order=1)
+    composer.train(CORPUS + EXTRA)
+    for seed in range(200):
+        random.seed(seed)
+        melody = composer.compose(length=20)
+        random.seed(seed)
+        assert melody == count_table_compose(CORPUS + EXTRA, 20)
+
+@pytest.mark.parametrize("durations", ["joint", "separate"])
+def test_saved_model_loads_memory_mapped(tmp_path, durations):
+    composer = MarkovComposer(order=3, durations=durations)
+    composer.train(CORPUS)
+    composer.save(str(tmp_path), "hash")
+    loaded, corpus_hash = MarkovComposer.load(str(tmp_path))
+    assert corpus_hash == "hash"
+    for chain in loaded.chains.values():
+        for table in chain.tables:
+            assert all(isinstance(getattr(table, name), np.memmap) for name in TransitionTable.ARRAYS)
+    assert loaded.compose_batch(50, seed=1) == composer.compose_batch(50, seed=1)
+
+def test_resaving_leaves_mapped_model_untouched(tmp_path):
+    composer = MarkovComposer(order=2)
+    composer.train(CORPUS)
+    composer.save(str(tmp_path), "hash")
+    mapped, _ = MarkovComposer.load(str(tmp_path))
+    before = table_arrays(mapped)
+
+    # Same corpus hash, different counts
+    composer.partial_train(EXTRA)
+    composer.save(str(tmp_path), "hash")
+    assert all(np.array_equal(a, b) for a, b in zip(before, table_arrays(mapped)))
+    reloaded, _ = MarkovComposer.load(str(tmp_path))
+    assert reloaded.num_transitions == composer.num_transitions > mapped.num_transitions
+
+def test_row_matches_batch_lookup():
+    rng = np.random.default_rng(0)
+    table = TransitionTable(2)
+    table.build(rng.integers(0, 30, (5000, 2)), rng.integers(0, 30, 5000), 30)
+    rows = {tuple(context): row for row, context in enumerate(table.contexts.tolist())}
+    # Ids 30 and 31 are past the radix, e.g. tokens added after the table was built
+    queries = list(itertools.product(range(32), repeat=2))
+    expected = [rows.get(query) for query in queries]
+    assert [table.row(query) for query in queries] == expected
+    batch = table.rows_batch(np.array(queries))
+    assert batch.tolist() == [-1 if row is None else row for row in expected]
+
+def test_incremental_training_matches_bulk():
+    bulk = MarkovComposer(order=3)
+    bulk.train(CORPUS + EXTRA)
+    incremental = MarkovComposer(order=3)
+    incremental.train(CORPUS)
+    for melody in EXTRA:
+        incremental.partial_train([melody])
+    incremental.finalize()
+
+    chain, expected = incremental.chains["token"], bulk.chains["token"]
+    assert chain.vocab == expected.vocab
+    assert any(len(delta) for _, _, delta in chain.layers)
+    assert np.array_equal(chain.transition_matrix(), expected.transition_matrix())
+    for melody in CORPUS + EXTRA:
+        ids = [chain.index[token] for token in melody.split()]
+        for end in range(1, len(ids) + 1):
+            got = list(chain.context_probs(ids[:end]))
+            want = list(expected.context_probs(ids[:end]))
+            assert len(got) == len(want)
+            assert all(np.allclose(g, w, rtol=0, atol=1e-12) for g, w in zip(got, want))
+
+    incremental.finalize(compact=True)
+    assert all(np.array_equal(a, b) for a, b in zip(table_arrays(incremental), table_arrays(bulk)))
+    assert incremental.compose_batch(50, seed=3) == bulk.compose_batch(50, seed=3)
+
+def test_uncompacted_sampling_frequencies_match_bulk():
+    bulk = MarkovComposer(order=3)
+    bulk.train(CORPUS + EXTRA)
+    incremental = MarkovComposer(order=3)
+    incremental.train(CORPUS)
+    incremental.partial_train(EXTRA)
+    incremental.finalize()
+
+    chain, expected = incremental.chains["token"], bulk.chains["token"]
+    samples = [melody.split() for melody in incremental.compose_batch(20000, length=4, seed=0, start_note="D4:1")]
+    # Next-token frequencies after the most common three-token opening, an order-3 context
+    prefix, _ = Counter(tuple(tokens[:3]) for tokens in samples).most_common(1)[0]
+    following = Counter(tokens[3] for tokens in samples if tuple(tokens[:3]) == prefix)
+    total = sum(following.values())
+    frequencies = np.array([following[token] / total for token in chain.vocab])
+    probs = next(expected.context_probs([expected.index[token] for token in prefix]))
+    assert total > 1000
+    assert 0.5 * np.abs(frequencies - probs).sum() < 0.05
+
+def test_compose_batch_is_reproducible_per_seed():
+    composer = MarkovComposer(order=2, durations="separate")
+    composer.train(CORPUS)
+    assert composer.compose_batch(20, seed=5) == composer.compose_batch(20, seed=5)
+    assert composer.compose_batch(20, seed=5) != composer.compose_batch(20, seed=6)
+
+@pytest.mark.parametrize("constraints, accept", [
+    (dict(allowed_pitches=["C", "D", "E"], end_note="C"),
+     lambda tokens: all(t[0] in "CDE" for t in tokens) and tokens[-1].startswith("C")),
+    (dict(total_beats=4),
+     lambda tokens: sum(float(t.split(":")[1]) for t in tokens) == 4),
+])
+def test_constrained_sampling_matches_rejection_sampling(constraints, accept):
+    composer = MarkovComposer(order=1)
+    composer.train(CORPUS)
+    expected = conditional_distribution(composer, 4, accept)
+    samples = [composer.compose_constrained(length=4, seed=seed, **constraints) for seed in range(10000)]
+    assert all(sample in expected for sample in samples)
+    assert total_variation(samples, expected) < 0.05
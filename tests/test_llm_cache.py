@@ -0,0 +1,114 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from music_gen.modules.llm_cache import LLMCache
+
+@pytest.fixture
+def cache(tmp_path):
+    return LLMCache(str(tmp_path / "llm_cache.db"))
+
+def run_threads(n, target):
+    # Starts n threads on target together and returns their results in order
+    results = [None] * n
+    barrier = threading.Barrier(n)
+
+    def worker(index):
+        barrier.wait()
+        try:
+            results[index] = target()
+        except Exception as e:
+            results[index] = e
+
+    threads = [threading.Thread(target=worker, args=(index,)) for index in range(n)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+def test_concurrent_callers_share_one_compute(cache):
+    calls = []
+
+    def compute():
+        calls.append(True)
+        time.sleep(0.2)
+        return "C4:1 E4:1"
+
+    results = run_threads(8, lambda: cache.get_or_compute("k", compute))
+    assert results == ["C4:1 E4:1"] * 8
+    assert len(calls) == 1
+    assert cache.get("k") == "C4:1 E4:1"
+
+def test_errors_reach_every_caller_and_are_not_cached(cache):
+    calls = []
+
+    def compute():
+        calls.append(True)
+        time.sleep(0.2)
+        raise RuntimeError("model down")
+
+    results = run_threads(4, lambda: cache.get_or_compute("k", compute))
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert len(calls) == 1
+    assert cache.get("k") is None
+
+def test_store_false_shares_but_does_not_cache(cache):
+    calls = []
+
+    def compute():
+        calls.append(True)
+        time.sleep(0.2)
+        return "not notes"
+
+    results = run_threads(4, lambda: cache.get_or_compute("k", compute, store=False))
+    assert results == ["not notes"] * 4
+    assert len(calls) == 1
+    assert cache.get("k") is None
+    # A later caller computes again
+    assert cache.get_or_compute("k", lambda: "C4:1 E4:1", store=False) == "C4:1 E4:1"
+    assert cache.get("k") is None
+
+def test_async_callers_share_one_compute(cache):
+    calls = []
+
+    async def acompute():
+        calls.append(True)
+        await asyncio.sleep(0.2)
+        return "C4:1 E4:1"
+
+    async def main():
+        return await asyncio.gather(*(cache.aget_or_compute("k", acompute) for _ in range(8)))
+
+    assert asyncio.run(main()) == ["C4:1 E4:1"] * 8
+    assert len(calls) == 1
+    assert cache.get("k") == "C4:1 E4:1"
+
+def test_cancelled_leader_hands_over_to_a_follower(cache):
+    calls = []
+    started = None
+
+    async def acompute():
+        calls.append(True)
+        started.set()
+        # The first (leader) call hangs until it is cancelled
+        await asyncio.sleep(60 if len(calls) == 1 else 0.1)
+        return f"reply {len(calls)}"
+
+    async def main():
+        nonlocal started
+        started = asyncio.Event()
+        leader = asyncio.create_task(cache.aget_or_compute("k", acompute))
+        await started.wait()
+        follower = asyncio.create_task(cache.aget_or_compute("k", acompute))
+        await asyncio.sleep(0.05)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await asyncio.wait_for(follower, 5)
+
+    assert asyncio.run(main()) == "reply 2"
+    assert len(calls) == 2
+    assert cache.get("k") == "reply 2"
@@ -0,0 +1,112 @@
+import wave
+
+import numpy as np
+import pytest
+
+from music_gen.modules.synthesizer import Synthesizer, WAVE_TYPES
+
+MELODY = "C4:1 E4:0.5 R:0.25 G4:0.75 A5:1.5 Bb3:0.3 R:1 F#6:0.125 C2:2 D#7:0.5 G1:1"
+
+def per_note_render(synth, note_sequence, bpm=120, oscillator=None, envelope=None):
+    """
+    The original one-note-at-a-time render: every note's wave times its envelope, a rest
+    or the note, then a 10 ms gap, all concatenated and normalized to the int16 peak.
+    """
+    beat_duration = 60.0 / bpm
+    parts = []
+    for token in note_sequence.split():
+        note, duration = token.split(":")
+        duration_sec = beat_duration * float(duration)
+        num_samples = int(synth.sample_rate * duration_sec)
+        freq = 0.0 if note.upper() in ["R", "REST"] else synth.get_frequency(note)
+        if freq > 0:
+            if oscillator is None:
+                note_wave = synth.generate_wave(freq, duration_sec)
+            else:
+                note_wave = oscillator(freq, duration_sec, num_samples)
+            parts.append(note_wave * (envelope or synth.get_envelope)(num_samples))
+        else:
+            parts.append(np.zeros(num_samples, dtype=synth.dtype))
+        parts.append(np.zeros(int(synth.sample_rate * 0.01), dtype=synth.dtype))
+    signal = np.concatenate(parts)
+    signal *= 32767 / np.max(np.abs(signal))
+    return signal.astype(np.int16)
+
+def original_envelope(num_samples):
+    # The fixed 10%/10%/0.7/20% ADSR the synthesizer started with
+    attack_len = int(0.1 * num_samples)
+    decay_len = int(0.1 * num_samples)
+    release_len = int(0.2 * num_samples)
+    sustain_len = num_samples - attack_len - decay_len - release_len
+    return np.concatenate([
+        np.linspace(0, 1, attack_len),
+        np.linspace(1, 0.7, decay_len),
+        np.full(sustain_len, 0.7),
+        np.linspace(0.7, 0, release_len),
+    ])
+
+def max_difference(a, b):
+    return int(np.abs(a.astype(np.int32) - b.astype(np.int32)).max())
+
+@pytest.mark.parametrize("dtype", [np.float64, np.float32])
+def test_block_render_matches_per_note_render(dtype):
+    synth = Synthesizer(dtype=dtype)
+    synth.block_size = 1000 # many block boundaries inside notes
+    assert np.array_equal(synth.generate_audio(MELODY), per_note_render(synth, MELODY))
+
+def test_default_envelope_matches_original():
+    synth = Synthesizer(dtype=np.float64)
+    for num_samples in list(range(60)) + [11025, 22050, 33075]:
+        assert np.array_equal(synth.get_envelope(num_samples), original_envelope(num_samples))
+
+def test_sine_wavetable_within_one_lsb_of_np_sin():
+    synth = Synthesizer(dtype=np.float64)
+    reference = per_note_render(
+        synth, MELODY,
+        oscillator=lambda freq, duration_sec, num_samples:
+            np.sin(freq * np.linspace(0, duration_sec, num_samples, False) * 2 * np.pi),
+        envelope=original_envelope,
+    )
+    assert max_difference(synth.generate_audio(MELODY), reference) <= 1
+
+@pytest.mark.parametrize("block_size", [1000, 4096, 1 << 20])
+def test_scanned_stream_matches_generate_audio(block_size):
+    synth = Synthesizer()
+    streamed = np.concatenate(list(synth.stream_audio(MELODY, block_size=block_size)))
+    assert np.array_equal(streamed, synth.generate_audio(MELODY))
+
+def test_render_to_wav_matches_generate_audio(tmp_path):
+    synth = Synthesizer()
+    path = str(tmp_path / "melody.wav")
+    frames = synth.render_to_wav(path, MELODY, verbose=False)
+    with wave.open(path, "rb") as f:
+        assert (f.getnchannels(), f.getsampwidth(), f.getframerate()) == (1, 2, synth.sample_rate)
+        samples = np.frombuffer(f.readframes(f.getnframes()), dtype="<i2")
+    assert frames == len(samples)
+    assert np.array_equal(samples, synth.generate_audio(MELODY))
+
+@pytest.mark.parametrize("wave_type", WAVE_TYPES)
+def test_float32_within_one_lsb_of_float64(wave_type):
+    reference = Synthesizer(dtype=np.float64).generate_audio(MELODY, wave_type=wave_type)
+    assert max_difference(Synthesizer().generate_audio(MELODY, wave_type=wave_type), reference) <= 1
+
+def test_repeated_renders_are_identical():
+    synth = Synthesizer()
+    first = synth.generate_audio(MELODY)
+    synth.generate_audio("C4:8") # a longer render in between
+    out = np.zeros(len(first) + 10, dtype=np.int16)
+    assert np.array_equal(synth.generate_audio(MELODY), first)
+    assert np.array_equal(synth.generate_audio(MELODY, out=out), first)
+
+def test_silent_extra_track_leaves_melody_unchanged():
+    synth = Synthesizer()
+    assert np.array_equal(synth.generate_audio("C4:1 E4:1 G4:2 | R:1 R:1"),
+                          synth.generate_audio("C4:1 E4:1 G4:2"))
+
+def test_streamed_tokens_match_bounded_stream():
+    synth = Synthesizer()
+    tokens = MELODY.split()
+    streamed = np.concatenate(list(synth.stream_tokens(iter(tokens))))
+    bounded = np.concatenate(list(synth.stream_audio(MELODY, peak="bound")))
+    assert np.array_equal(streamed, bounded)
+    assert max_difference(synth.normalize(streamed), synth.generate_audio(MELODY)) <= 1